@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+import sys, logging, asyncio
+from pysip2.server import Server
+from pysip2.message import Message, FixedField, Field
+from pysip2.spec import MessageSpec as mspec
+from pysip2.spec import FieldSpec as fspec
+from pysip2.spec import FixedFieldSpec as ffspec
+
+'''
+Minimal ACS answering Item Information requests for any barcode.
+
+PYTHONPATH=../src/ ./acs-server.py [port]
+'''
+
+logging.basicConfig(level=logging.INFO)
+
+async def authenticate(session, username, password, location_code):
+    return username == 'sip' and password == 'sip'
+
+server = Server('0.0.0.0', int(sys.argv[1]) if len(sys.argv) > 1 else 6001,
+    authenticate = authenticate, institution = 'example')
+
+@server.handler(mspec.item_info)
+async def item_info(session, msg):
+    return Message(
+        spec = mspec.item_info_resp,
+        fixed_fields = [
+            FixedField(ffspec.circ_status, '03'), # available
+            FixedField(ffspec.security_marker, '00'),
+            FixedField(ffspec.fee_type, '01'),
+            FixedField(ffspec.date, Message.sipdate())
+        ],
+        fields = [
+            Field(fspec.item_id, msg.get_field_value('AB')),
+            Field(fspec.title_id, 'Example Title')
+        ]
+    )
+
+asyncio.run(server.serve_forever())
@@ -40,7 +40,7 @@ client.login(username, password, location_code)
 
 resp = client.checkin_request(copy_barcode, location_code)
 
-if resp.get_fixed_field_by_name('ok').value == '1':
+if resp.view().ok:
     print(" * Checkin Succeeded")
 else:
     print(" * Checkin Failed")
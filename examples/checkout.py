@@ -40,7 +40,7 @@ client.connect()
 client.login(username, password, location_code)
 resp = client.checkout_request(copy_barcode, patron_barcode)
 
-if resp.get_fixed_field_by_name('ok').value == '1':
+if resp.view().ok:
     print(" * Checkout Succeeded")
 else:
     print(" * Checkout Failed")
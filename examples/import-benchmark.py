@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+import os, sys, subprocess
+
+'''
+Checks that importing pysip2.client stays fast.
+
+Imports it in fresh interpreters under python -X importtime and reports
+the median cumulative import time of each pysip2 module.  Fails (exit 1)
+if pysip2.client takes longer than the budget, or if a module that is
+only needed later (ssl, random, numpy) is imported eagerly.
+
+PYTHONPATH=../src/ ./import-benchmark.py [budget ms] [runs]
+'''
+
+budget = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+runs = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+# modules the client must not pull in at import time
+DEFERRED = ('ssl', 'random', 'numpy')
+
+CHECK = 'import sys, pysip2.client; ' \
+    'print(",".join([m for m in %r if m in sys.modules]))' % (DEFERRED,)
+
+def import_times():
+    ''' Returns ({module: cumulative microseconds}, eager modules) for
+    one fresh interpreter.
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHECK],
+        capture_output = True, text = True, env = os.environ, check = True)
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) != 3 or not line.startswith('import time:'):
+            continue
+        name = parts[2].strip()
+        if name.startswith('pysip2'):
+            times[name] = int(parts[1])
+
+    eager = [m for m in proc.stdout.strip().split(',') if m]
+    return times, eager
+
+samples = {}
+eager = set()
+for i in range(runs):
+    times, modules = import_times()
+    eager.update(modules)
+    for name, usec in times.items():
+        samples.setdefault(name, []).append(usec)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+print('%-24s %10s' % ('module', 'median ms'))
+for name in sorted(samples, key = lambda n: -median(samples[n])):
+    print('%-24s %10.1f' % (name, median(samples[name]) / 1000))
+
+failures = []
+client_ms = median(samples.get('pysip2.client', [0])) / 1000
+if client_ms > budget:
+    failures.append('pysip2.client took %.1f ms (budget %.1f ms)' %
+        (client_ms, budget))
+for name in sorted(eager):
+    failures.append('%s is imported eagerly' % name)
+
+for failure in failures:
+    print('FAIL: %s' % failure)
+
+sys.exit(1 if failures else 0)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+import sys, gc, tracemalloc
+from pysip2.client import Client
+from pysip2.transport import LoopbackTransport
+from pysip2.spec import MessageSpec as mspec
+from pysip2.spec import FieldSpec as fspec
+
+'''
+Checks that a long-running client does not grow in memory.
+
+Drives a Client against an in-process fake ACS through login, SC Status,
+Item Information, Patron Information and Checkin, under tracemalloc.
+The fake ACS adds a different nonstandard field code to every response,
+as a misbehaving server might.  Fails (exit 1) if the ClientLog or spec
+registries grow, if memory retained per message exceeds the retained
+budget, or if the traced peak of one iteration, per message, exceeds
+the allocation budget.  Prints the top allocation sites either way.
+
+PYTHONPATH=../src/ ./memory-benchmark.py [iterations] \\
+    [retained budget bytes] [allocation budget bytes]
+'''
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+budget = float(sys.argv[2]) if len(sys.argv) > 2 else 16
+alloc_budget = float(sys.argv[3]) if len(sys.argv) > 3 else 2048
+warmup = min(1000, iterations)
+DATE = '20240101    093000'
+
+def field(frame, code):
+    return frame.split('|' + code, 1)[1].split('|', 1)[0]
+
+def acs(frame):
+    ''' Fake ACS; answers each request frame '''
+    txt = frame.decode()
+    code = txt[:2]
+
+    # a new nonstandard field code per response
+    acs.count = acs.count + 1
+    extra = 'X' + chr(0x100 + acs.count % 5000) + 'extra|'
+
+    if code == '93':
+        resp = '941'
+    elif code == '99':
+        resp = '98YYYYNN010003' + DATE + '2.00AOexample|AMMain|' \
+            'BXYYYYYYYYYYYYYYYY|' + extra
+    elif code == '17':
+        resp = '18030001' + DATE + 'AB' + field(txt, 'AB') \
+            + '|AJSome Title|AQmain|BHUSD|' + extra
+    elif code == '63':
+        resp = '64              001' + DATE + '0001000200030000' \
+            '00000000AOexample|AA' + field(txt, 'AA') + '|AEJane Doe|' \
+            'BLY|AUitem1|AUitem2|AUitem3|' + extra
+    elif code == '09':
+        resp = '101YNN' + DATE + 'AOexample|AB' + field(txt, 'AB') \
+            + '|AQmain|CTmain|' + extra
+    else:
+        return None
+
+    return (resp + '\r').encode()
+
+acs.count = 0
+
+client = Client('acs', 6001, transport = LoopbackTransport(acs))
+client.connect()
+
+def run(start, count):
+    for i in range(start, start + count):
+        client.login('sip', 'sip', 'bench')
+        client.sc_status()
+        client.item_info_request('3123400%07d' % i)
+        client.patron_info_request('2123400%07d' % i)
+        client.checkin_request('3123400%07d' % i, 'bench')
+
+# trace the warmup too, so the ClientLog is already full of traced
+# entries when the baseline is taken
+tracemalloc.start()
+run(0, warmup)
+gc.collect()
+
+field_specs = len(fspec.registry)
+message_specs = len(mspec.registry)
+
+start = tracemalloc.take_snapshot()
+start_size = tracemalloc.get_traced_memory()[0]
+
+run(warmup, iterations)
+gc.collect()
+
+end_size, peak = tracemalloc.get_traced_memory()
+end = tracemalloc.take_snapshot()
+
+# bytes allocated per message: the traced peak of single iterations,
+# above the memory in use before each
+peaks = []
+for i in range(min(1000, iterations)):
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    run(warmup + iterations + i, 1)
+    peaks.append((tracemalloc.get_traced_memory()[1] - before) / 5)
+tracemalloc.stop()
+peaks.sort()
+allocated = peaks[len(peaks) // 2]
+
+messages = iterations * 5
+retained = (end_size - start_size) / messages
+
+print('messages:        %d' % messages)
+print('retained/msg:    %.2f bytes (budget %.2f)' % (retained, budget))
+print('peak above base: %d bytes' % (peak - start_size))
+print('allocated/msg:   %.2f bytes median, %.2f max (budget %.2f)' % (
+    allocated, peaks[-1], alloc_budget))
+print('client log:      %d messages, %d finished' % (
+    len(client.client_log.messages), client.client_log.finished))
+print('field specs:     %d' % len(fspec.registry))
+print('\nTop allocation sites:')
+for stat in end.compare_to(start, 'lineno')[:10]:
+    print('  %s' % stat)
+
+failures = []
+if retained > budget:
+    failures.append('retained %.2f bytes per message' % retained)
+if allocated > alloc_budget:
+    failures.append('allocated %.2f bytes per message' % allocated)
+if client.client_log.messages.maxlen is None or \
+        len(client.client_log.messages) > client.client_log.messages.maxlen:
+    failures.append('ClientLog.messages is unbounded')
+if len(fspec.registry) != field_specs:
+    failures.append('FieldSpec.registry grew by %d' %
+        (len(fspec.registry) - field_specs))
+if len(mspec.registry) != message_specs:
+    failures.append('MessageSpec.registry grew by %d' %
+        (len(mspec.registry) - message_specs))
+
+for failure in failures:
+    print('FAIL: %s' % failure)
+
+sys.exit(1 if failures else 0)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+import sys, json, pickle, timeit
+from pysip2.message import Message
+
+'''
+Compares Message serialization paths on a large 64 Patron Information
+Response.  msgpack is included when installed.
+
+PYTHONPATH=../src/ ./serialize-benchmark.py [item count] [iterations]
+'''
+
+items = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+number = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+msg = Message(msg_txt = '64              00120240101    093000'
+    + '0000' * 6 + 'AOexample|AA21234000123456|AEJane Doe|BLY|'
+    + ''.join(['AU3123400%07d|' % i for i in range(items)]) + '\r')
+
+def graph_dumps(m):
+    # what pickle stored before Message.__reduce__: the spec objects
+    return pickle.dumps((m.spec, m.fixed_fields, m.fields))
+
+def graph_loads(data):
+    spec, fixed_fields, fields = pickle.loads(data)
+    return Message(spec = spec, fixed_fields = fixed_fields, fields = fields)
+
+paths = [
+    ('pickle (object graph)', graph_dumps, graph_loads),
+    ('pickle (by code)', pickle.dumps, pickle.loads),
+    ('to_wire', Message.to_wire, Message.from_wire),
+    ('to_dict + json', lambda m: json.dumps(m.to_dict()),
+        lambda d: Message.from_dict(json.loads(d))),
+    ('SIP2 frame', Message.to_bytes,
+        lambda d: Message(msg_txt = d.decode()))
+]
+
+try:
+    import msgpack
+    paths.append(('to_dict + msgpack', lambda m: msgpack.packb(m.to_dict()),
+        lambda d: Message.from_dict(msgpack.unpackb(d))))
+except ImportError:
+    pass
+
+print('%-22s %8s %10s %10s' % ('', 'bytes', 'dump us', 'load us'))
+for name, dumps, loads in paths:
+    data = dumps(msg)
+    assert loads(data).to_bytes() == msg.to_bytes()
+    dump = timeit.timeit(lambda: dumps(msg), number = number)
+    load = timeit.timeit(lambda: loads(data), number = number)
+    print('%-22s %8d %10.1f %10.1f' % (name, len(data),
+        dump * 1e6 / number, load * 1e6 / number))
@@ -0,0 +1,285 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Load balancing across several ACS endpoints.
+
+Each endpoint has its own ClientPool.  Requests go to the endpoint with
+the fewest outstanding requests ('least_outstanding') or the lowest
+latency-weighted load ('ewma').  An endpoint is ejected when it fails
+repeatedly or is much slower than its peers.  A background thread
+re-admits it once it answers a 99 SC Status probe.
+
+    balancer = Balancer([('sip1', 6001), ('sip2', 6001)],
+        lambda server, port: Client(server, port), 4,
+        username, password, location_code)
+    resp = balancer.call('item_info_request', barcode)
+'''
+import time, random, logging, threading
+from pysip2.pool import ClientPool
+
+STRATEGIES = ('least_outstanding', 'ewma')
+
+def parse_endpoints(value, default_port=None):
+    ''' Parses "host1:6001, host2, [::1]:6001" into a list of
+    (server, port) tuples.
+    '''
+    endpoints = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item.startswith('['): # [ipv6]:port
+            host, _, port = item[1:].partition(']')
+            port = port.lstrip(':')
+        elif item.count(':') == 1:
+            host, port = item.split(':')
+        else:
+            host, port = item, ''
+        endpoints.append((host, int(port) if port else default_port))
+    return endpoints
+
+
+class Endpoint(object):
+    ''' One ACS endpoint, its client pool and its health '''
+
+    def __init__(self, server, port, pool):
+        self.server = server
+        self.port = port
+        self.pool = pool
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.failures = 0
+        self.ejected = False
+        self.ejected_time = 0
+        self.requests = 0
+        self.errors = 0
+
+    def __str__(self):
+        return '%s:%s' % (self.server, self.port)
+
+    def load(self, strategy, default_ewma=1.0):
+        ''' default_ewma stands in for the latency of an endpoint with
+        no measurement yet, so its outstanding requests still count.
+        '''
+        if strategy == 'ewma':
+            return (self.ewma or default_ewma) * (self.outstanding + 1)
+        return self.outstanding
+
+
+class Balancer(object):
+    ''' Spreads Client calls across several ACS endpoints '''
+
+    def __init__(self, endpoints, make_client, size, username, password,
+            location_code, **kwargs):
+        '''
+        endpoints : list of (server, port) tuples
+        make_client : function(server, port) returning a new,
+            unconnected Client
+        size : pool size per endpoint
+
+        kwargs:
+            strategy : 'least_outstanding' (default) or 'ewma'
+            decay : weight of the newest latency in the EWMA.
+                Default 0.3
+            max_failures : consecutive failures that eject an endpoint.
+                Default 3.
+            slow_factor : eject an endpoint whose EWMA latency exceeds
+                this multiple of the fastest healthy endpoint.
+                Default 5.0.  0 disables.
+            min_requests : requests an endpoint must serve before it
+                can be ejected as slow.  Default 20.
+            eject_time : seconds an ejected endpoint waits before it is
+                probed.  Default 30.
+            probe_interval : seconds between probe passes.  Default 5.
+                0 disables the probe thread; call probe_ejected() yourself.
+
+            guard, acquire_timeout, rate_limiter and priority are passed
+                to each ClientPool.
+        '''
+        self.strategy = kwargs.get('strategy', 'least_outstanding')
+        if self.strategy not in STRATEGIES:
+            raise ValueError('Unknown balancing strategy: %s' % self.strategy)
+
+        self.decay = kwargs.get('decay', 0.3)
+        self.max_failures = kwargs.get('max_failures', 3)
+        self.slow_factor = kwargs.get('slow_factor', 5.0)
+        self.min_requests = kwargs.get('min_requests', 20)
+        self.eject_time = kwargs.get('eject_time', 30)
+        self.probe_interval = kwargs.get('probe_interval', 5)
+
+        pool_args = dict([(k, kwargs[k])
+            for k in ('guard', 'acquire_timeout', 'rate_limiter', 'priority')
+            if k in kwargs])
+
+        self.endpoints = []
+        for server, port in endpoints:
+            pool = ClientPool(
+                lambda s=server, p=port: make_client(s, p),
+                size, username, password, location_code, **pool_args)
+            self.endpoints.append(Endpoint(server, port, pool))
+
+        if len(self.endpoints) == 0:
+            raise ValueError('Balancer needs at least one endpoint')
+
+        self.lock = threading.Lock()
+        self.closed = False
+        self.prober = None
+
+        if self.probe_interval:
+            self.prober = threading.Thread(target=self.probe_forever,
+                name='sip-balancer-probe', daemon=True)
+            self.prober.start()
+
+    def choose(self):
+        ''' Picks the endpoint for the next request and counts it as
+        outstanding.
+        '''
+        with self.lock:
+            healthy = [e for e in self.endpoints if not e.ejected]
+            if len(healthy) == 0:
+                # better to try a sick endpoint than to fail outright
+                healthy = self.endpoints
+
+            # unmeasured endpoints are assumed to be as fast as the
+            # average of their peers
+            measured = [e.ewma for e in healthy if e.ewma > 0]
+            default = sum(measured) / len(measured) if measured else 1.0
+
+            loads = [(e.load(self.strategy, default), e) for e in healthy]
+            lowest = min(load for load, e in loads)
+            endpoint = random.choice(
+                [e for load, e in loads if load == lowest])
+
+            endpoint.outstanding = endpoint.outstanding + 1
+            return endpoint
+
+    def call(self, method, *args, **kwargs):
+        ''' Runs a Client method on the chosen endpoint, e.g.
+        balancer.call('item_info_request', barcode)
+        '''
+        endpoint = self.choose()
+        start_time = time.time()
+
+        try:
+            resp = endpoint.pool.call(method, *args, **kwargs)
+        except (IOError, OSError):
+            self.record_failure(endpoint)
+            raise
+        except:
+            with self.lock:
+                endpoint.outstanding = endpoint.outstanding - 1
+            raise
+
+        self.record_success(endpoint, time.time() - start_time)
+        return resp
+
+    def record_success(self, endpoint, latency):
+        with self.lock:
+            endpoint.outstanding = endpoint.outstanding - 1
+            endpoint.requests = endpoint.requests + 1
+            endpoint.failures = 0
+
+            if endpoint.ewma == 0.0:
+                endpoint.ewma = latency
+            else:
+                endpoint.ewma = (self.decay * latency +
+                    (1 - self.decay) * endpoint.ewma)
+
+            if not self.slow_factor or endpoint.ejected or \
+                    endpoint.requests < self.min_requests:
+                return
+
+            peers = [e.ewma for e in self.endpoints
+                if e is not endpoint and not e.ejected and e.ewma > 0]
+            if len(peers) == 0 or \
+                    endpoint.ewma <= min(peers) * self.slow_factor:
+                return
+
+            self.eject(endpoint, 'EWMA latency %.3fs' % endpoint.ewma)
+
+    def record_failure(self, endpoint):
+        with self.lock:
+            endpoint.outstanding = endpoint.outstanding - 1
+            endpoint.requests = endpoint.requests + 1
+            endpoint.errors = endpoint.errors + 1
+            endpoint.failures = endpoint.failures + 1
+
+            if not endpoint.ejected and \
+                    endpoint.failures >= self.max_failures:
+                self.eject(endpoint,
+                    '%d consecutive failures' % endpoint.failures)
+
+    def eject(self, endpoint, reason):
+        ''' Takes an endpoint out of rotation.  Caller holds the lock. '''
+        logging.warn('Ejecting SIP endpoint %s: %s' % (endpoint, reason))
+        endpoint.ejected = True
+        endpoint.ejected_time = time.time()
+
+    def probe(self, endpoint):
+        ''' Sends a 99 SC Status to the endpoint.  Returns True if it
+        answered and reports itself online.
+        '''
+        try:
+            resp = endpoint.pool.call('sc_status')
+        except Exception as e:
+            logging.info('SIP endpoint %s probe failed: %s' % (endpoint, e))
+            return False
+        return resp.view().online_status
+
+    def probe_ejected(self):
+        ''' Probes ejected endpoints whose eject_time has passed and
+        re-admits the ones that answer.
+        '''
+        now = time.time()
+        with self.lock:
+            due = [e for e in self.endpoints if e.ejected and
+                now - e.ejected_time >= self.eject_time]
+
+        for endpoint in due:
+            ok = self.probe(endpoint)
+            with self.lock:
+                if ok:
+                    logging.info('Re-admitting SIP endpoint %s' % endpoint)
+                    endpoint.ejected = False
+                    endpoint.failures = 0
+                    endpoint.requests = 0
+                    endpoint.ewma = 0.0
+                else:
+                    endpoint.ejected_time = time.time()
+
+    def probe_forever(self):
+        while not self.closed:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe_ejected()
+            except Exception as e:
+                logging.error('SIP endpoint probe pass failed: %s' % e)
+
+    def stats(self):
+        ''' Returns per-endpoint statistics '''
+        with self.lock:
+            return dict([(str(e), {
+                'outstanding': e.outstanding,
+                'ewma_latency': e.ewma,
+                'requests': e.requests,
+                'errors': e.errors,
+                'ejected': e.ejected
+            }) for e in self.endpoints])
+
+    def close(self):
+        ''' Stops probing and disconnects every pooled client '''
+        self.closed = True
+        for endpoint in self.endpoints:
+            endpoint.pool.close()
@@ -12,13 +12,16 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 # -----------------------------------------------------------------------
-import sys, socket, ssl, random, time, logging
+import sys, time, logging, collections
 from gettext import gettext as _
 from pysip2.spec import MessageSpec as mspec
 from pysip2.spec import FieldSpec as fspec
 from pysip2.spec import FixedFieldSpec as ffspec
 from pysip2.spec import TEXT_ENCODING, LINE_TERMINATOR, SOCKET_BUFSIZE
 from pysip2.message import Message, FixedField, Field
+from pysip2.transport import TcpTransport, TlsTransport, UnixTransport
+from pysip2.dates import format_sipdate
+from pysip2.observers import EVENTS, LoggingObserver, RedactingObserver
 
 class ProtocolError(Exception):
     ''' Invalid messages fields, header values, etc '''
@@ -28,16 +31,89 @@ class Client(object):
     ''' SIP2 client connection '''
 
     LINE_TERMINATOR_LEN = len(LINE_TERMINATOR)
-
-    def __init__(self, server, port):
+    LINE_TERMINATOR_BYTES = LINE_TERMINATOR.encode(TEXT_ENCODING)
+
+    # Patron Information summary categories.
+    # kind => (summary position, count fixed field name, item field code)
+    PATRON_ITEM_KINDS = {
+        'hold'         : (0, 'hold_items_count',    fspec.hold_items.code),
+        'overdue'      : (1, 'overdue_items_count', fspec.overdue_items.code),
+        'charged'      : (2, 'charged_items_count', fspec.charged_items.code),
+        'fine'         : (3, 'fine_items_count',    fspec.fine_items.code),
+        'recall'       : (4, 'recall_items_count',  fspec.recall_items.code),
+        'unavail_hold' : (5, 'unavail_holds_count',
+            fspec.unavail_hold_items.code)
+    }
+
+    def __init__(self, server, port, transport=None):
         self.server = server
         self.port = port
-        self.sock = None
-        self.ssl_enabled = False 
         self.default_institution = None # optional default institution
         self.terminal_pwd = None # optional terminal password
         self.client_log = ClientLog()
 
+        # A caller-provided transport is used as-is.  Otherwise one is
+        # built from the socket/ssl options on each connect().
+        self.transport = transport
+        self.own_transport = transport is None
+
+        # bytes received but not yet consumed as a complete message
+        self.recv_buf = bytearray()
+
+        self.rate_limiter = None
+        self.rate_priority = None
+
+        self.tracer = None
+        self.intern_table = None # pysip2.message.InternTable
+        # when the first byte of the current response frame arrived
+        self.first_byte_time = 0
+
+        # Observer hooks per event, rebuilt by observe()/unobserve().
+        # An empty tuple means nothing to call.
+        self.observers = []
+        for event in EVENTS:
+            setattr(self, event + '_hooks', ())
+
+        # keep the long-standing SENDING/RECEIVED debug log, but only
+        # pay for it when debug logging is on.  Patron identifiers,
+        # passwords and names are masked; callers may unobserve() it
+        # and install their own.
+        self.default_observer = None
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.default_observer = RedactingObserver(LoggingObserver())
+            self.observe(self.default_observer)
+
+        self.socket_args()
+        self.ssl_args()
+
+    @property
+    def sock(self):
+        ''' The underlying socket, if the transport has one '''
+        return getattr(self.transport, 'sock', None)
+
+    def socket_args(self, **kwargs):
+        ''' Apply socket options
+
+        kwargs:
+            unix_socket : path to a Unix domain socket to connect to
+                instead of server:port.
+            read_size : max bytes read from the socket per recv call.
+                Defaults to SOCKET_BUFSIZE.
+
+            All other options are passed to TcpTransport: tcp_nodelay,
+            keepalive, keepalive_idle, keepalive_interval,
+            keepalive_count, recv_bufsize, address_family,
+            dns_cache_ttl and timeout.
+        '''
+        self.socket_options = dict(kwargs)
+        self.unix_socket = self.socket_options.pop('unix_socket', None)
+        self.read_size = self.socket_options.pop('read_size', SOCKET_BUFSIZE)
+        self.read_buf = bytearray(self.read_size)
+
+        family = kwargs.get('address_family', 'any')
+        if family not in TcpTransport.ADDRESS_FAMILIES:
+            raise ValueError('Invalid address family: %s' % family)
+
     def ssl_args(self, **kwargs):
         ''' Enable SSL connections and apply SSL options
 
@@ -46,42 +122,53 @@ class Client(object):
             require_valid_cert : fail on untrusted certificate
             check_hostname : fail if the certificate hostname does 
                 not match SIP server hostname.
+            context : use this ssl.SSLContext instead of the shared
+                context for the server.
+            session_reuse : resume the previous TLS session on
+                reconnect.  Defaults to on.
         '''
-        self.ssl_enabled = kwargs.get('enabled', False)
-        self.ssl_require_valid_cert = kwargs.get('require_valid_cert', True)
-        self.ssl_check_hostname = kwargs.get('check_hostname', True)
+        self.ssl_options = dict(kwargs)
+        self.ssl_enabled = self.ssl_options.pop('enabled', False)
+
+    def build_transport(self):
+        ''' Returns a new Transport for the configured options '''
+
+        if self.unix_socket is not None:
+            return UnixTransport(
+                self.unix_socket, self.socket_options.get('timeout'))
+
+        if self.ssl_enabled:
+            options = dict(self.socket_options)
+            options.update(self.ssl_options)
+            return TlsTransport(self.server, self.port, **options)
+
+        return TcpTransport(self.server, self.port, **self.socket_options)
 
     def connect(self):
         ''' Connects to the SIP2 server '''
-        logging.debug(
-            'connecting to server %s:%s' % (self.server, self.port))
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.server, self.port))
 
-        if self.ssl_enabled: self.setup_ssl();
+        if self.own_transport:
+            self.transport = self.build_transport()
 
-    def setup_ssl(self):
-        context = ssl.create_default_context()
+        logging.debug('connecting to server %s' % self.transport)
 
-        if self.ssl_require_valid_cert:
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.check_hostname = self.ssl_check_hostname
-        else:
-            logging.warn('SSL certificate checks disabled. ' +
-                'This is probably not what you want!')
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
+        del self.recv_buf[:]
+        # requests sent on an earlier connection will never be answered
+        self.client_log.pending.clear()
+        start_time = time.time()
+        self.transport.connect()
 
-        logging.debug('setting up SSL connection')
+        if self.transport.handshake is not None:
+            self.client_log.log_handshake(*self.transport.handshake)
 
-        self.sock = context.wrap_socket(
-            self.sock, server_hostname=self.server)
+        if self.tracer is not None:
+            self.tracer.trace_connect(self.endpoint(),
+                start_time, time.time(), self.transport.handshake)
 
     def disconnect(self):
         ''' Disconnects from the SIP2 server '''
-        logging.debug(
-            'disconnecting from server %s:%s' % (self.server, self.port))
-        self.sock.close()
+        logging.debug('disconnecting from server %s' % self.transport)
+        self.transport.close()
 
     def log_summary(self):
         ''' Log message summary statistics '''
@@ -91,22 +178,149 @@ class Client(object):
         ''' Log all messages and summary statistics '''
         self.client_log.log_messages()
 
-    def send_msg(self, msg):
-        ''' Sends a Message to the server '''
-        msg_txt = str(msg)
-        logging.debug('SENDING: %s' % msg_txt)
-        self.client_log.start_msg(msg.spec)
-        self.sock.send(bytes(msg_txt + LINE_TERMINATOR, TEXT_ENCODING))
+    def rate_limit(self, limiter, priority='interactive'):
+        ''' Apply a pysip2.limits.RateLimiter to every message sent.
+
+        priority is 'interactive' or 'batch'.  Batch clients only use
+        capacity that interactive clients leave over.
+        '''
+        self.rate_limiter = limiter
+        self.rate_priority = priority
+
+    def observe(self, observer):
+        ''' Install a pysip2.observers.Observer '''
+        self.observers.append(observer)
+        self.build_hooks()
+
+    def unobserve(self, observer):
+        ''' Remove a previously installed Observer '''
+        self.observers.remove(observer)
+        self.build_hooks()
+
+    def build_hooks(self):
+        for event in EVENTS:
+            setattr(self, event + '_hooks', tuple([getattr(o, event)
+                for o in self.observers if o.handles(event)]))
+
+    def notify_error(self, exc):
+        for hook in self.error_hooks:
+            hook(self, exc)
+
+    def trace(self, tracer):
+        ''' Export per-phase request timing to a pysip2.trace.Tracer '''
+        self.tracer = tracer
+
+    def endpoint(self):
+        ''' Name of the ACS endpoint, used as the rate limit key '''
+        if self.unix_socket is not None:
+            return self.unix_socket
+        return '%s:%s' % (self.server, self.port)
+
+    def send_msg(self, msg, expect_reply=True):
+        ''' Sends a Message to the server
+
+        expect_reply : False for messages the server never answers
+            (Block Patron), so no round trip is logged for them.
+        '''
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(
+                self.endpoint(), msg.spec.code, self.rate_priority)
+
+        for hook in self.pre_send_hooks:
+            hook(self, msg)
+
+        if expect_reply:
+            self.client_log.start_msg(msg.spec)
+        try:
+            self.transport.send([msg.to_bytes()])
+        except Exception as e:
+            if expect_reply:
+                self.client_log.drop_pending(1)
+            self.notify_error(e)
+            raise
+        if expect_reply:
+            self.client_log.sent_msgs(1)
+
+        for hook in self.post_send_hooks:
+            hook(self, msg)
+
+    def send_msgs(self, msgs):
+        ''' Sends a batch of Messages to the server with as few
+        writes as possible.
+
+        Nothing is read from the socket.  The caller is responsible
+        for collecting one response per message via recv_msg().
+        '''
+        msgs = list(msgs) # iterated more than once
+
+        if self.rate_limiter is not None:
+            # take every token before anything is logged as pending, so
+            # a refusal part way through leaves nothing behind
+            taken = []
+            try:
+                for msg in msgs:
+                    self.rate_limiter.acquire(
+                        self.endpoint(), msg.spec.code, self.rate_priority)
+                    taken.append(msg)
+            except:
+                for msg in taken:
+                    self.rate_limiter.release(self.endpoint(), msg.spec.code)
+                raise
+
+        bufs = []
+        for msg in msgs:
+            for hook in self.pre_send_hooks:
+                hook(self, msg)
+            self.client_log.start_msg(msg.spec)
+            bufs.append(msg.to_bytes())
+
+        try:
+            self.transport.send(bufs)
+        except Exception as e:
+            self.client_log.drop_pending(len(bufs))
+            self.notify_error(e)
+            raise
+        self.client_log.sent_msgs(len(bufs))
+
+        if self.post_send_hooks:
+            for msg in msgs:
+                for hook in self.post_send_hooks:
+                    hook(self, msg)
+
+    def send_bytes(self, bufs):
+        ''' Writes a list of pre-encoded frames to the server '''
+        self.transport.send(bufs)
+
+    def recv_frame(self):
+        ''' Receives one complete, line-terminated frame as bytes.
+
+        Bytes following the terminator (e.g. the next response of a
+        pipelined batch) are kept for the next call.
+        '''
+
+        term = Client.LINE_TERMINATOR_BYTES
+        buf = self.recv_buf
+        view = memoryview(self.read_buf)
+        scan_from = 0
 
-    def recv_msg(self):
-        ''' Receives a Message from the server '''
+        # bytes left over from a previous read count as arriving now
+        if len(buf) > 0:
+            self.first_byte_time = time.time()
 
-        msg_txt = ''
         while True:
+            idx = buf.find(term, scan_from)
+            if idx >= 0:
+                break
+
+            # don't rescan bytes already known not to hold a terminator
+            scan_from = max(0, len(buf) - len(term) + 1)
 
-            buf = self.sock.recv(SOCKET_BUFSIZE)
+            nbytes = self.transport.recv_into(view)
 
-            if buf is None or len(buf) == 0: # server kicked us off
+            if len(buf) == 0:
+                self.first_byte_time = time.time()
+
+            if nbytes == 0: # server kicked us off
                 try:
                     # disconnect if we can
                     self.disconnect()
@@ -114,15 +328,52 @@ class Client(object):
                     pass
                 raise IOError("Disconnected from SIP2 server");
 
-            msg_txt = msg_txt + buf.decode(TEXT_ENCODING)
+            buf += view[:nbytes]
 
-            if msg_txt[-Client.LINE_TERMINATOR_LEN:] == LINE_TERMINATOR:
-                break
+        end = idx + len(term)
+        frame = bytes(buf[:end])
+        del buf[:end]
+
+        return frame
+
+    def recv_msg(self, only_fields=None):
+        ''' Receives a Message from the server
+
+        only_fields : optional field codes, e.g. ('AF', 'AB').  Only
+            these Fields are built; the full text is kept in msg_txt.
+        '''
 
-        self.client_log.finish_msg()
-        logging.debug("RECEIVED: " + msg_txt)
+        try:
+            frame = self.recv_frame()
+        except Exception as e:
+            # the response being waited for is not coming
+            self.client_log.drop_pending(1, oldest=True)
+            self.notify_error(e)
+            raise
+        frame_time = time.time()
 
-        return Message(msg_txt = msg_txt)
+        for hook in self.frame_received_hooks:
+            hook(self, frame)
+
+        if self.intern_table is None and only_fields is None:
+            msg = Message(msg_txt = frame.decode(TEXT_ENCODING))
+        else:
+            kwargs = {}
+            if self.intern_table is not None:
+                kwargs['intern_table'] = self.intern_table
+            if only_fields is not None:
+                kwargs['only_fields'] = only_fields
+            msg = Message(msg_txt = frame.decode(TEXT_ENCODING), **kwargs)
+
+        logged = self.client_log.finish_msg(self.first_byte_time, frame_time)
+        if self.tracer is not None and logged is not None and \
+                self.tracer.sample():
+            self.tracer.trace_message(self.endpoint(), logged)
+
+        for hook in self.parsed_hooks:
+            hook(self, msg)
+
+        return msg
 
 
     def sc_status(self, **kwargs):
@@ -181,8 +432,8 @@ class Client(object):
         self.send_msg(msg)
         resp = self.recv_msg()
 
-        # the OK field is 1/0 value in the fixed fields
-        if resp.fixed_fields[0].value == '1':
+        view = resp.view()
+        if view is not None and view.spec is mspec.login_resp and view.ok:
             logging.debug("login succeeded for %s" % username)
             return True
 
@@ -260,6 +511,15 @@ class Client(object):
 
         logging.debug("patron_information_request() for %s" % patron_id)
 
+        self.send_msg(self.patron_info_message(patron_id, **kwargs))
+        return self.recv_msg()
+
+    def patron_info_message(self, patron_id, **kwargs):
+        ''' Builds a Patron Information Request message.
+
+        Accepts the same kwargs as patron_info_request().
+        '''
+
         # summary may contain up to 1 "Y" value.
         summary = kwargs.get('summary', '          ')
         if summary.count('Y') > 1:
@@ -284,8 +544,84 @@ class Client(object):
         msg.maybe_add_field(fspec.start_item, kwargs.get('start_item'))
         msg.maybe_add_field(fspec.end_item, kwargs.get('end_item'))
 
-        self.send_msg(msg)
-        return self.recv_msg()
+        return msg
+
+    def iter_patron_items(self, patron_id, kind, page_size=20, **kwargs):
+        ''' Generator yielding a patron's item identifiers for one
+        summary category, requesting them a page at a time.
+
+        kind is one of the PATRON_ITEM_KINDS keys: 'hold', 'overdue',
+        'charged', 'fine', 'recall', 'unavail_hold'.
+
+        Paging stops once the item count reported in the response
+        fixed fields has been covered.  If the server does not report
+        a usable count, paging stops at the first short page.
+
+        optional kwargs
+            - prefetch
+                -- when true, the request for the next page is sent
+                    before the items of the current page are yielded,
+                    so the server works while the caller does.
+            - any patron_info_request() kwarg except summary,
+                start_item and end_item.
+        '''
+
+        if kind not in Client.PATRON_ITEM_KINDS:
+            raise ValueError('Invalid patron item kind: %s' % kind)
+
+        if page_size < 1:
+            raise ValueError('page_size must be positive')
+
+        position, count_name, code = Client.PATRON_ITEM_KINDS[kind]
+        prefetch = kwargs.pop('prefetch', False)
+        kwargs['summary'] = ' ' * position + 'Y' + ' ' * (9 - position)
+
+        def send_page(start):
+            kwargs['start_item'] = str(start)
+            kwargs['end_item'] = str(start + page_size - 1)
+            self.send_msg(self.patron_info_message(patron_id, **kwargs))
+
+        logging.debug("iter_patron_items() for %s kind=%s" % (patron_id, kind))
+
+        start = 1
+        send_page(start)
+        outstanding = True
+
+        try:
+            while True:
+                # cleared first, so a failed receive is not retried
+                # on a dead connection below
+                outstanding = False
+                resp = self.recv_msg()
+
+                items = resp.get_field_values(code)
+                count = resp.get_fixed_field_by_name(count_name).value.strip()
+                next_start = start + page_size
+
+                if count.isdigit():
+                    more = next_start <= int(count) and len(items) > 0
+                else:
+                    more = len(items) >= page_size
+
+                if more and prefetch:
+                    send_page(next_start)
+                    outstanding = True
+
+                for item in items:
+                    yield item
+
+                if not more:
+                    break
+
+                start = next_start
+                if not prefetch:
+                    send_page(start)
+                    outstanding = True
+        finally:
+            # A caller that stops iterating early must not leave an
+            # unread response on the connection.
+            if outstanding:
+                self.recv_msg()
 
     def checkout_request(self, item_id, patron_id, **kwargs):
         ''' Send a Checkout message.
@@ -296,6 +632,9 @@ class Client(object):
             - sc_renewal_policy
             - no_block
             - nb_due_date
+                -- SIP2 date string or datetime
+            - transaction_date
+                -- SIP2 date string or datetime.  Defaults to now.
             - item_properties
             - fee acknowledged
             - cancel
@@ -305,6 +644,9 @@ class Client(object):
             "checkout_request() for patron=%s and item=%s" % (
             patron_id, item_id))
 
+        now = format_sipdate(kwargs.get('transaction_date')) or \
+            Message.sipdate()
+
         msg = Message(
             spec = mspec.checkout,
             fixed_fields = [
@@ -314,10 +656,10 @@ class Client(object):
                 FixedField(
                     ffspec.no_block,
                     kwargs.get('no_block', 'N')),
-                FixedField(ffspec.date, Message.sipdate()),
+                FixedField(ffspec.date, now),
                 FixedField(
                     ffspec.nb_due_date, 
-                    kwargs.get('nb_due_date', Message.sipdate()))
+                    format_sipdate(kwargs.get('nb_due_date', now)))
             ],
         )
 
@@ -340,6 +682,102 @@ class Client(object):
         self.send_msg(msg)
         return self.recv_msg()
 
+    def renew_request(self, item_id, patron_id, **kwargs):
+        ''' Send a Renew message.
+
+        Arguments are in checkout_request() order.  Either item_id or
+        the title_id kwarg identifies the item; pass item_id=None to
+        renew by title.
+
+        kwargs
+            - institution
+                -- required if default_institution is unset
+            - title_id
+            - third_party_allowed
+            - no_block
+            - nb_due_date
+                -- SIP2 date string or datetime
+            - patron_pwd
+            - item_properties
+            - fee_acknowledged
+        '''
+
+        logging.debug(
+            "renew_request() for patron=%s and item=%s" % (
+            patron_id, item_id))
+
+        now = Message.sipdate()
+
+        msg = Message(
+            spec = mspec.renew,
+            fixed_fields = [
+                FixedField(
+                    ffspec.third_party_allowed,
+                    kwargs.get('third_party_allowed', 'N')),
+                FixedField(
+                    ffspec.no_block,
+                    kwargs.get('no_block', 'N')),
+                FixedField(ffspec.date, now),
+                FixedField(
+                    ffspec.nb_due_date,
+                    format_sipdate(kwargs.get('nb_due_date', now)))
+            ],
+        )
+
+        msg.add_field(
+            fspec.institution_id,
+            kwargs.get('institution', self.default_institution))
+
+        msg.add_field(fspec.patron_id, patron_id)
+        msg.maybe_add_field(fspec.patron_pwd, kwargs.get('patron_pwd'))
+        msg.maybe_add_field(fspec.item_id, item_id)
+        msg.maybe_add_field(fspec.title_id, kwargs.get('title_id'))
+        msg.maybe_add_field(fspec.terminal_pwd, self.terminal_pwd)
+        msg.maybe_add_field(
+            fspec.item_properties, kwargs.get('item_properties'))
+        msg.maybe_add_field(
+            fspec.fee_acknowledged, kwargs.get('fee_acknowledged'))
+
+        self.send_msg(msg)
+        return self.recv_msg()
+
+    def renew_all_request(self, patron_id, **kwargs):
+        ''' Send a Renew All message, renewing every item charged to
+        the patron in a single round-trip.
+
+        The renewed and unrenewed item identifiers are available from
+        the response via get_field_values('BM') and
+        get_field_values('BN').
+
+        kwargs
+            - institution
+                -- required if default_institution is unset
+            - patron_pwd
+            - fee_acknowledged
+        '''
+
+        logging.debug("renew_all_request() for patron %s" % patron_id)
+
+        msg = Message(
+            spec = mspec.renew_all,
+            fixed_fields = [
+                FixedField(ffspec.date, Message.sipdate())
+            ]
+        )
+
+        msg.add_field(
+            fspec.institution_id,
+            kwargs.get('institution', self.default_institution))
+
+        msg.add_field(fspec.patron_id, patron_id)
+        msg.maybe_add_field(fspec.patron_pwd, kwargs.get('patron_pwd'))
+        msg.maybe_add_field(fspec.terminal_pwd, self.terminal_pwd)
+        msg.maybe_add_field(
+            fspec.fee_acknowledged, kwargs.get('fee_acknowledged'))
+
+        self.send_msg(msg)
+        return self.recv_msg()
+
     def checkin_request(self, item_id, current_location, **kwargs):
         ''' Send a Checkin message.
 
@@ -348,6 +786,9 @@ class Client(object):
                 -- required if default_institution is unset
             - no_block
             - return_date
+                -- SIP2 date string or datetime
+            - transaction_date
+                -- SIP2 date string or datetime.  Defaults to now.
             - item_properties
             - cancel
         '''
@@ -355,16 +796,19 @@ class Client(object):
         logging.debug(
             "checkin_request() for item %s" % (item_id))
 
+        now = format_sipdate(kwargs.get('transaction_date')) or \
+            Message.sipdate()
+
         msg = Message(
             spec = mspec.checkin,
             fixed_fields = [
                 FixedField(
                     ffspec.no_block,
                     kwargs.get('no_block', 'N')),
-                FixedField(ffspec.date, Message.sipdate()),
+                FixedField(ffspec.date, now),
                 FixedField(
                     ffspec.return_date, 
-                    kwargs.get('return_date', Message.sipdate()))
+                    format_sipdate(kwargs.get('return_date', now)))
             ],
         )
 
@@ -445,6 +889,192 @@ class Client(object):
         return self.recv_msg()
 
 
+    def hold_request(self, patron_id, hold_mode, **kwargs):
+        ''' Send a Hold message.
+
+        hold_mode is '+' (add), '-' (delete) or '*' (change).
+        One of the item_id or title_id kwargs identifies the item.
+
+        kwargs
+            - institution
+                -- required if default_institution is unset
+            - item_id
+            - title_id
+            - expiration_date
+                -- SIP2 date string or datetime
+            - pickup_location
+            - hold_type
+            - patron_pwd
+            - fee_acknowledged
+        '''
+
+        logging.debug(
+            "hold_request() for patron %s mode %s" % (patron_id, hold_mode))
+
+        if hold_mode not in ('+', '-', '*'):
+            raise ProtocolError('Invalid hold mode: %s' % hold_mode)
+
+        msg = Message(
+            spec = mspec.hold,
+            fixed_fields = [
+                FixedField(ffspec.hold_mode, hold_mode),
+                FixedField(ffspec.date, Message.sipdate())
+            ]
+        )
+
+        msg.maybe_add_field(fspec.expiration_date,
+            format_sipdate(kwargs.get('expiration_date')))
+        msg.maybe_add_field(
+            fspec.pickup_location, kwargs.get('pickup_location'))
+        msg.maybe_add_field(fspec.hold_type, kwargs.get('hold_type'))
+
+        msg.add_field(
+            fspec.institution_id,
+            kwargs.get('institution', self.default_institution))
+
+        msg.add_field(fspec.patron_id, patron_id)
+        msg.maybe_add_field(fspec.patron_pwd, kwargs.get('patron_pwd'))
+        msg.maybe_add_field(fspec.item_id, kwargs.get('item_id'))
+        msg.maybe_add_field(fspec.title_id, kwargs.get('title_id'))
+        msg.maybe_add_field(fspec.terminal_pwd, self.terminal_pwd)
+        msg.maybe_add_field(
+            fspec.fee_acknowledged, kwargs.get('fee_acknowledged'))
+
+        self.send_msg(msg)
+        return self.recv_msg()
+
+    def block_patron(self, patron_id, blocked_card_msg, **kwargs):
+        ''' Send a Block Patron message.
+
+        The ACS does not respond to this message, so nothing is read
+        back from the server.
+
+        kwargs
+            - institution
+                -- required if default_institution is unset
+            - card_retained
+                -- Y/N, defaults to N
+        '''
+
+        logging.debug("block_patron() for patron %s" % patron_id)
+
+        msg = Message(
+            spec = mspec.block_patron,
+            fixed_fields = [
+                FixedField(
+                    ffspec.card_retained,
+                    kwargs.get('card_retained', 'N')),
+                FixedField(ffspec.date, Message.sipdate())
+            ]
+        )
+
+        msg.add_field(
+            fspec.institution_id,
+            kwargs.get('institution', self.default_institution))
+
+        msg.add_field(fspec.blocked_card_msg, blocked_card_msg)
+        msg.add_field(fspec.patron_id, patron_id)
+        msg.add_field(fspec.terminal_pwd, self.terminal_pwd or '')
+
+        # no response expected, so there is no round-trip to time
+        self.send_msg(msg, expect_reply=False)
+
+    def item_status_update(self, item_id, item_properties, **kwargs):
+        ''' Send an Item Status Update message.
+
+        kwargs
+            - institution
+                -- required if default_institution is unset
+        '''
+
+        logging.debug("item_status_update() for item %s" % item_id)
+
+        msg = Message(
+            spec = mspec.item_status_update,
+            fixed_fields = [
+                FixedField(ffspec.date, Message.sipdate())
+            ]
+        )
+
+        msg.add_field(
+            fspec.institution_id,
+            kwargs.get('institution', self.default_institution))
+
+        msg.add_field(fspec.item_id, item_id)
+        msg.maybe_add_field(fspec.terminal_pwd, self.terminal_pwd)
+        msg.add_field(fspec.item_properties, item_properties)
+
+        self.send_msg(msg)
+        return self.recv_msg()
+
+    def patron_enable_request(self, patron_id, **kwargs):
+        ''' Send a Patron Enable message.
+
+        kwargs
+            - institution
+                -- required if default_institution is unset
+            - patron_pwd
+        '''
+
+        logging.debug("patron_enable_request() for patron %s" % patron_id)
+
+        msg = Message(
+            spec = mspec.patron_enable,
+            fixed_fields = [
+                FixedField(ffspec.date, Message.sipdate())
+            ]
+        )
+
+        msg.add_field(
+            fspec.institution_id,
+            kwargs.get('institution', self.default_institution))
+
+        msg.add_field(fspec.patron_id, patron_id)
+        msg.maybe_add_field(fspec.terminal_pwd, self.terminal_pwd)
+        msg.maybe_add_field(fspec.patron_pwd, kwargs.get('patron_pwd'))
+
+        self.send_msg(msg)
+        return self.recv_msg()
+
+    def end_patron_session(self, patron_id, **kwargs):
+        ''' Send an End Patron Session message.
+
+        kwargs
+            - institution
+                -- required if default_institution is unset
+            - patron_pwd
+        '''
+
+        logging.debug("end_patron_session() for patron %s" % patron_id)
+
+        msg = Message(
+            spec = mspec.end_patron_session,
+            fixed_fields = [
+                FixedField(ffspec.date, Message.sipdate())
+            ]
+        )
+
+        msg.add_field(
+            fspec.institution_id,
+            kwargs.get('institution', self.default_institution))
+
+        msg.add_field(fspec.patron_id, patron_id)
+        msg.maybe_add_field(fspec.terminal_pwd, self.terminal_pwd)
+        msg.maybe_add_field(fspec.patron_pwd, kwargs.get('patron_pwd'))
+
+        self.send_msg(msg)
+        return self.recv_msg()
+
+    def acs_resend_request(self):
+        ''' Send a Request ACS Resend message, asking the server to
+        repeat its last response.
+        '''
+
+        logging.debug("acs_resend_request()")
+
+        self.send_msg(Message(spec = mspec.acs_resend))
+        return self.recv_msg()
+
 class ClientLog(object):
     '''
     Collect round-trip timing information for client requests.
@@ -457,50 +1087,122 @@ class ClientLog(object):
         def __init__(self, spec, start_time):
             self.spec = spec
             self.start_time = start_time
-            self.end_time = 0
-            self.duration = 0
+            self.sent_time = 0
+            self.first_byte_time = 0
+            self.frame_time = 0
+            self.end_time = 0 # response parsed
+            self.duration = 0 # request start to response frame complete
 
         def __str__(self):
             return _('duration: {0:.3f} [{1}] {2}').format(
                 self.duration, self.spec.code, self.spec.label)
 
-    def __init__(self):
-        self.messages = []
-        self.current_msg = None
+    class Handshake(object):
+        '''
+        Models a single TLS handshake
+        '''
+        def __init__(self, duration, resumed):
+            self.duration = duration
+            self.resumed = resumed
+
+        def __str__(self):
+            return _('handshake: {0:.3f} resumed={1}').format(
+                self.duration, self.resumed)
+
+    def __init__(self, max_messages=1000):
+        '''
+        max_messages : completed messages and handshakes kept for
+            log_messages().  Older entries are dropped so long-running
+            clients don't grow without bound.  None keeps everything.
+            log_summary() totals always cover every message.
+        '''
+        self.messages = collections.deque(maxlen=max_messages)
+        self.finished = 0 # completed messages, including dropped ones
+        self.total_duration = 0.0
+
+        # TLS handshakes are timed separately from request round-trips
+        self.handshakes = collections.deque(maxlen=max_messages)
+        self.handshake_count = 0
+        self.handshake_time = 0.0
+        self.handshakes_resumed = 0
+
+        # Sent messages awaiting a response, oldest first.  There is
+        # more than one entry when requests are pipelined.
+        self.pending = collections.deque()
 
     def start_msg(self, spec):
         ''' Start tracking a new message '''
-        self.current_msg = ClientLog.ClientMessage(spec, time.time())
+        self.pending.append(ClientLog.ClientMessage(spec, time.time()))
 
-    def finish_msg(self):
-        ''' Complete collecting data on the current message '''
-        self.current_msg.end_time = time.time()
-        self.current_msg.duration = \
-            self.current_msg.end_time - self.current_msg.start_time
-        self.messages.append(self.current_msg)
-        self.current_msg = None
+    def drop_pending(self, count, oldest=False):
+        ''' Forget count pending messages that will get no response.
+        The newest are dropped unless oldest is set.
+        '''
+        for i in range(min(count, len(self.pending))):
+            if oldest:
+                self.pending.popleft()
+            else:
+                self.pending.pop()
+
+    def sent_msgs(self, count):
+        ''' Mark the newest count pending messages as sent '''
+        now = time.time()
+        for i in range(1, min(count, len(self.pending)) + 1):
+            self.pending[-i].sent_time = now
+
+    def finish_msg(self, first_byte_time=0, frame_time=0):
+        ''' Complete collecting data on the oldest pending message.
+        Returns the completed ClientMessage.
+        '''
+        if len(self.pending) == 0:
+            return None
+
+        msg = self.pending.popleft()
+        msg.end_time = time.time()
+        msg.frame_time = frame_time or msg.end_time
+        # a response can't arrive before its request was sent
+        msg.first_byte_time = max(first_byte_time, msg.sent_time) \
+            if first_byte_time else 0
+        msg.duration = msg.frame_time - msg.start_time
+        self.messages.append(msg)
+        self.finished = self.finished + 1
+        self.total_duration = self.total_duration + msg.duration
+        return msg
+
+    def log_handshake(self, duration, resumed):
+        ''' Record the duration of a TLS handshake '''
+        self.handshakes.append(ClientLog.Handshake(duration, resumed))
+        self.handshake_count = self.handshake_count + 1
+        self.handshake_time = self.handshake_time + duration
+        if resumed:
+            self.handshakes_resumed = self.handshakes_resumed + 1
 
     def log_summary(self):
         ''' Logs summary information on collected messages '''
 
-        if len(self.messages) == 0:
+        if self.handshake_count > 0:
+            logging.info(_('TLS handshakes {0} ({1} resumed), '
+                'total time {2:.3f}').format(self.handshake_count,
+                    self.handshakes_resumed, self.handshake_time))
+
+        if self.finished == 0:
             logging.info(_('No messages collected'))
             return
 
-        total_duration = 0
-        for msg in self.messages:
-            total_duration = total_duration + msg.duration
-
-        avg_duration = total_duration / len(self.messages)
-        logging.info(_('Total request time {0:.3f}').format(total_duration))
+        avg_duration = self.total_duration / self.finished
+        logging.info(_('Total request time {0:.3f}').format(
+            self.total_duration))
         logging.info(_('Average request time {0:.3f}').format(avg_duration))
 
     def log_messages(self):
-        ''' Logs data on all collected messages '''
+        ''' Logs data on the retained messages '''
 
         if len(self.messages) == 0:
             logging.info(_('No messages collected'))
             return
 
+        for hs in self.handshakes:
+            logging.info(str(hs))
+
         for msg in self.messages:
             logging.info(str(msg))
@@ -0,0 +1,330 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Columnar batch parsing of captured SIP2 traffic.
+
+parse_many() parses a stream of frames straight into per-message-code
+column tables without creating Message or Field objects.  Each table
+has one list per fixed field, and one value list per variable field
+code.  Each value list has a parallel list of row numbers, since a
+field can be missing from a row or repeated in it.
+
+    store = parse_many(open('capture.log', 'rb').read())
+    items = store['18']
+    items.fixed['circ_status'][:10]
+    items.values('AB')
+
+Captures too large for memory can be exported chunk by chunk:
+
+    export(open('capture.log', 'rb'), sys.stdout, '64')
+'''
+import csv, json, codecs
+from pysip2.spec import MessageSpec as mspec
+from pysip2.spec import TEXT_ENCODING, LINE_TERMINATOR
+
+def iter_frames(source, terminator=LINE_TERMINATOR, read_size=65536):
+    ''' Yields frames (without terminators) from a buffer, a file
+    object or an iterable of frames.  A trailing '\\n' after each
+    terminator, as written by most capture tools, is ignored.
+
+    Text (str) input, including reads from files opened in text mode,
+    also treats '\\n' as a terminator, since universal newline mode
+    translates every '\\r' to '\\n'.  Open captures in binary mode
+    to keep '\\n' inside frames.
+    '''
+    if isinstance(source, str):
+        source = source.replace('\n', terminator)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        source = bytes(source).decode(TEXT_ENCODING)
+
+    if isinstance(source, str):
+        for frame in source.split(terminator):
+            frame = frame.strip('\n')
+            if frame:
+                yield frame
+        return
+
+    if hasattr(source, 'read'):
+        tail = ''
+        # a multi-byte character may straddle two reads
+        decoder = codecs.getincrementaldecoder(TEXT_ENCODING)()
+        while True:
+            chunk = source.read(read_size)
+            if not chunk:
+                break
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            else:
+                chunk = chunk.replace('\n', terminator)
+            frames = (tail + chunk).split(terminator)
+            tail = frames.pop()
+            for frame in frames:
+                frame = frame.strip('\n')
+                if frame:
+                    yield frame
+        tail = (tail + decoder.decode(b'', True)).strip('\n')
+        if tail:
+            yield tail
+        return
+
+    for frame in source:
+        if isinstance(frame, bytes):
+            frame = frame.decode(TEXT_ENCODING)
+        frame = frame.rstrip('\r\n')
+        if frame:
+            yield frame
+
+
+class ColumnTable(object):
+    ''' Column storage for all parsed messages of one message code '''
+
+    def __init__(self, code, intern_table=None):
+        self.code = code
+        self.spec = mspec.registry.get(code)
+        self.rows = 0
+        self.intern_table = intern_table
+
+        # fixed field name => value per row
+        self.fixed = {}
+        # (name, start, end, intern) slices of the message text
+        self.slices = []
+        if self.spec is not None:
+            for ffspec, offset in self.spec.fixed_field_offsets():
+                self.fixed[ffspec.name] = []
+                self.slices.append((ffspec.name, offset,
+                    offset + ffspec.length, intern_table is not None and
+                    ffspec.name in intern_table.fixed_fields))
+            self.body_offset = self.slices[-1][2] if self.slices else 2
+        else:
+            # unknown message layout; keep the raw text
+            self.fixed['raw'] = []
+            self.body_offset = None
+
+        # field code => [values], [row numbers]
+        self.field_values = {}
+        self.field_rows = {}
+
+    def append(self, txt):
+        row = self.rows
+        self.rows = row + 1
+
+        if self.body_offset is None:
+            self.fixed['raw'].append(txt)
+            return
+
+        fixed = self.fixed
+        table = self.intern_table
+        for name, start, end, intern in self.slices:
+            if intern:
+                fixed[name].append(table.intern(txt[start:end]))
+            else:
+                fixed[name].append(txt[start:end])
+
+        body = txt[self.body_offset:]
+        if not body:
+            return
+
+        field_values = self.field_values
+        field_rows = self.field_rows
+        for part in body.split('|'):
+            if part == '':
+                break
+            code = part[:2]
+            values = field_values.get(code)
+            if values is None:
+                values = field_values[code] = []
+                field_rows[code] = []
+            if table is not None and code in table.field_codes:
+                values.append(table.intern(part[2:]))
+            else:
+                values.append(part[2:])
+            field_rows[code].append(row)
+
+    def values(self, code):
+        ''' All values of a field code, in row order '''
+        return self.field_values.get(code, [])
+
+    def offsets(self, code):
+        ''' Row offsets for a field code: the values of row i are
+        values(code)[offsets[i]:offsets[i + 1]].
+        '''
+        offsets = [0] * (self.rows + 1)
+        for row in self.field_rows.get(code, []):
+            offsets[row + 1] = offsets[row + 1] + 1
+        for i in range(self.rows):
+            offsets[i + 1] = offsets[i + 1] + offsets[i]
+        return offsets
+
+    def field_codes(self):
+        return sorted(self.field_values.keys())
+
+    def iter_rows(self):
+        ''' Yields one dict per row.  Fixed fields map to strings,
+        variable fields to lists of values.
+        '''
+        codes = self.field_codes()
+        # per-code read position; row numbers only ever increase
+        cursors = dict([(c, 0) for c in codes])
+
+        for row in range(self.rows):
+            record = dict([(name, col[row])
+                for name, col in self.fixed.items()])
+
+            for code in codes:
+                rows = self.field_rows[code]
+                pos = start = cursors[code]
+                while pos < len(rows) and rows[pos] == row:
+                    pos = pos + 1
+                if pos > start:
+                    record[code] = self.field_values[code][start:pos]
+                cursors[code] = pos
+
+            yield record
+
+    def to_numpy(self):
+        ''' Returns a dict of NumPy arrays: one fixed-width string array
+        per fixed field, plus '<code>' value and '<code>.rows' row
+        number arrays per field code.  Requires numpy.
+        '''
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('ColumnTable.to_numpy() requires numpy')
+
+        arrays = {}
+        for name, col in self.fixed.items():
+            arrays[name] = numpy.array(col, dtype=str)
+        for code in self.field_codes():
+            arrays[code] = numpy.array(self.field_values[code], dtype=object)
+            arrays[code + '.rows'] = numpy.array(
+                self.field_rows[code], dtype=numpy.int64)
+        return arrays
+
+
+class ColumnStore(dict):
+    ''' Message code => ColumnTable '''
+
+    def __init__(self, intern_table=None):
+        super(ColumnStore, self).__init__()
+        self.intern_table = intern_table
+
+    def append(self, txt):
+        code = txt[:2]
+        table = self.get(code)
+        if table is None:
+            table = self[code] = ColumnTable(code, self.intern_table)
+        table.append(txt)
+
+    def rows(self):
+        return sum([t.rows for t in self.values()])
+
+
+def parse_many(source, **kwargs):
+    ''' Parses a buffer, file object or iterable of frames into a
+    ColumnStore.
+
+    kwargs:
+        codes : only keep messages with these codes, e.g. ('18', '64')
+        intern_table : pysip2.message.InternTable for repeated values
+        backend : 'numpy' returns {code: ColumnTable.to_numpy()}
+            instead of a ColumnStore.
+    '''
+    codes = kwargs.get('codes')
+    store = ColumnStore(kwargs.get('intern_table'))
+
+    for frame in iter_frames(source):
+        if codes is None or frame[:2] in codes:
+            store.append(frame)
+
+    if kwargs.get('backend') == 'numpy':
+        return dict([(c, t.to_numpy()) for c, t in store.items()])
+    return store
+
+def iter_chunks(source, chunk_size=100000, codes=None):
+    ''' Yields a ColumnStore per chunk_size frames, so a capture can be
+    processed without holding all of it in memory.
+    '''
+    store = ColumnStore()
+    count = 0
+    for frame in iter_frames(source):
+        if codes is not None and frame[:2] not in codes:
+            continue
+        store.append(frame)
+        count = count + 1
+        if count == chunk_size:
+            yield store
+            store = ColumnStore()
+            count = 0
+    if count > 0:
+        yield store
+
+def csv_columns(source, code, chunk_size=100000):
+    ''' The fixed field names of a message code followed by every field
+    code found in the source, i.e. the CSV columns export() writes.
+    '''
+    codes = set()
+    for store in iter_chunks(source, chunk_size, (code,)):
+        if code in store:
+            codes.update(store[code].field_codes())
+    return list(ColumnTable(code).fixed.keys()) + sorted(codes)
+
+def export(source, out, code, fmt='csv', chunk_size=100000, sep=';',
+        columns=None):
+    ''' Streams all messages with the given code to out as CSV (fmt
+    'csv') or JSON lines (fmt 'jsonl').  Returns the number of rows
+    written.
+
+    CSV columns are the fixed fields followed by every field code in
+    the source, found by a first pass over it; repeated values are
+    joined with sep.  A source that can't be read twice (a pipe or an
+    iterator) needs explicit columns, see csv_columns(), or 'jsonl'.
+    JSON lines keep every field code and list values.
+    '''
+    written = 0
+    writer = None
+
+    if fmt != 'jsonl' and columns is None:
+        if isinstance(source, (str, bytes, bytearray, memoryview)):
+            columns = csv_columns(source, code, chunk_size)
+        elif hasattr(source, 'seekable') and source.seekable():
+            start = source.tell()
+            columns = csv_columns(source, code, chunk_size)
+            source.seek(start)
+        else:
+            raise ValueError(
+                'CSV export of a stream needs columns; use fmt=jsonl')
+
+    for store in iter_chunks(source, chunk_size, (code,)):
+        table = store.get(code)
+        if table is None:
+            continue
+
+        if fmt == 'jsonl':
+            for record in table.iter_rows():
+                out.write(json.dumps(record) + '\n')
+                written = written + 1
+            continue
+
+        if writer is None:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+
+        for record in table.iter_rows():
+            writer.writerow([
+                sep.join(v) if isinstance(v, list) else v
+                for v in [record.get(c, '') for c in columns]])
+            written = written + 1
+
+    return written
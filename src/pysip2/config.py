@@ -0,0 +1,75 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Client settings from pysip2-client.ini, shared by the command line tools.
+'''
+import itertools
+from pysip2.client import Client
+from pysip2.balance import parse_endpoints
+
+BOOLEAN_OPTIONS = ('tcp_nodelay', 'keepalive')
+INTEGER_OPTIONS = ('keepalive_idle', 'keepalive_interval', 'keepalive_count',
+    'recv_bufsize', 'read_size', 'dns_cache_ttl', 'timeout')
+STRING_OPTIONS = ('address_family', 'unix_socket')
+
+def socket_args(client_conf):
+    ''' Client.socket_args() kwargs from a [client] section '''
+    args = {}
+    for key in BOOLEAN_OPTIONS:
+        if key in client_conf:
+            args[key] = client_conf.getboolean(key)
+    for key in INTEGER_OPTIONS:
+        if key in client_conf:
+            args[key] = client_conf.getint(key)
+    for key in STRING_OPTIONS:
+        if key in client_conf:
+            args[key] = client_conf[key]
+    return args
+
+def ssl_args(config):
+    ''' Client.ssl_args() kwargs from the [ssl] section, or None if
+    there is no such section.
+    '''
+    if 'ssl' not in config:
+        return None
+    ssl_conf = config['ssl']
+    return {
+        'enabled': ssl_conf.getboolean('enabled', False),
+        'require_valid_cert': ssl_conf.getboolean('require_valid_cert', True),
+        'check_hostname': ssl_conf.getboolean('check_hostname', True)
+    }
+
+def client_factory(config):
+    ''' Returns a function building new, unconnected Clients from the
+    [client] and [ssl] sections of a ConfigParser.  With several
+    endpoints configured, clients are spread round-robin over them.
+    '''
+    client_conf = config['client']
+    port = client_conf.getint('port') if client_conf.get('port') else None
+    endpoints = itertools.cycle(
+        parse_endpoints(client_conf.get('endpoints', ''), port) or
+        [(client_conf.get('server'), port)])
+    sockets = socket_args(client_conf)
+    ssl = ssl_args(config)
+
+    def make_client():
+        client = Client(*next(endpoints))
+        client.default_institution = client_conf.get('institution')
+        client.socket_args(**sockets)
+        if ssl is not None:
+            client.ssl_args(**ssl)
+        return client
+
+    return make_client
@@ -0,0 +1,87 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+SIP2 date formatting and parsing.
+
+SIP2 dates are 18 characters: YYYYMMDDZZZZHHMMSS, where ZZZZ is a
+right-justified timezone.  All blanks means local time and 'Z' means UTC.
+'''
+import time, datetime, functools
+from pysip2.spec import SIP_DATETIME
+
+UTC_ZONES = ('Z', 'UTC', 'GMT')
+
+class SipClock(object):
+    ''' Returns the current time as a SIP2 date string.  The formatted
+    value is cached for the current wall-clock second.
+    '''
+
+    def __init__(self):
+        # (epoch second, formatted date) -- replaced as a single tuple
+        # so concurrent callers never see a mismatched pair.
+        self.cached = (None, None)
+
+    def now(self):
+        second = int(time.time())
+        cached = self.cached
+        if cached[0] == second:
+            return cached[1]
+
+        txt = time.strftime(SIP_DATETIME, time.localtime(second))
+        self.cached = (second, txt)
+        return txt
+
+sip_clock = SipClock()
+
+def format_sipdate(value):
+    ''' Formats a datetime as a SIP2 date.  Timezone-aware values are
+    converted to local time.  Strings are returned unchanged.
+    '''
+    if value is None or isinstance(value, str):
+        return value
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value.strftime(SIP_DATETIME)
+
+@functools.lru_cache(maxsize=4096)
+def parse_sipdate(value):
+    ''' Parses a SIP2 date string into a timezone-aware datetime.
+
+    Blank and unrecognized timezones are treated as local time.
+    Returns None if the value is not a SIP2 date.  Results are
+    memoized, since the same few dates repeat across many messages.
+    '''
+
+    if value is None or len(value) < 18:
+        return None
+
+    ymd = value[0:8]
+    zone = value[8:12].strip()
+    hms = value[12:18]
+
+    if not (ymd.isdigit() and hms.isdigit()):
+        return None
+
+    try:
+        dt = datetime.datetime(
+            int(ymd[0:4]), int(ymd[4:6]), int(ymd[6:8]),
+            int(hms[0:2]), int(hms[2:4]), int(hms[4:6]))
+    except ValueError:
+        return None
+
+    if zone in UTC_ZONES:
+        return dt.replace(tzinfo=datetime.timezone.utc)
+
+    return dt.astimezone()
@@ -0,0 +1,155 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Hedged requests for read-only lookups.
+
+If a lookup has not been answered within a percentile of recent
+latency, a duplicate is sent on a second pooled session and whichever
+answers first wins.  The losing request still runs to completion on
+its own session, and its response is read and discarded.  That keeps
+the session in sync for its next use.
+
+Only the read-only messages in HEDGEABLE are ever hedged.  Checkout,
+checkin, fee paid and other state-changing requests go through
+unhedged.
+'''
+import time, logging, threading, collections
+import concurrent.futures as futures
+from pysip2.pool import PoolTimeoutError
+
+# Client method => message code, for the requests that may be hedged.
+HEDGEABLE = {
+    'item_info_request'     : '17',
+    'patron_status_request' : '23',
+    'patron_info_request'   : '63',
+    'sc_status'             : '99'
+}
+
+class Hedger(object):
+    ''' Issues hedged requests through a ClientPool '''
+
+    def __init__(self, pool, **kwargs):
+        '''
+        kwargs:
+            percentile : latency percentile (0-100) after which a hedge
+                is sent.  Default 95.
+            min_samples : recent latencies needed before hedging starts.
+                Default 20.
+            window : number of recent latencies kept.  Default 200.
+            min_delay : never hedge sooner than this many seconds.
+                Default 0.01
+        '''
+        self.pool = pool
+        self.percentile = kwargs.get('percentile', 95)
+        self.min_samples = kwargs.get('min_samples', 20)
+        self.min_delay = kwargs.get('min_delay', 0.01)
+        self.latencies = collections.deque(maxlen=kwargs.get('window', 200))
+
+        # primary and hedge may both be in flight for every pooled client
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=pool.size * 2, thread_name_prefix='sip-hedge')
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self):
+        ''' Seconds to wait before hedging, or None if there is not
+        enough latency data yet.
+        '''
+        samples = sorted(self.latencies)
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1,
+            int(len(samples) * self.percentile / 100.0))
+        return max(self.min_delay, samples[index])
+
+    def timed_call(self, method, args, kwargs, hedge=False):
+        start_time = time.time()
+
+        # Only hedge if another session is free right now; queueing the
+        # hedge behind other work would not help the tail.
+        with self.pool.client(0 if hedge else None) as client:
+            if hedge:
+                with self.lock:
+                    self.hedges = self.hedges + 1
+            resp = self.pool.run(client, method, *args, **kwargs)
+
+        self.latencies.append(time.time() - start_time)
+        return resp
+
+    def call(self, method, *args, **kwargs):
+        ''' Like ClientPool.call(), hedging requests in HEDGEABLE '''
+
+        if method not in HEDGEABLE:
+            return self.pool.call(method, *args, **kwargs)
+
+        with self.lock:
+            self.calls = self.calls + 1
+
+        delay = self.hedge_delay()
+        primary = self.executor.submit(self.timed_call, method, args, kwargs)
+
+        try:
+            return primary.result(timeout=delay)
+        except futures.TimeoutError:
+            pass
+
+        hedge = self.executor.submit(
+            self.timed_call, method, args, kwargs, True)
+
+        # First successful answer wins.  The loser keeps running in its
+        # worker thread and hands its session back once drained.
+        pending = set([primary, hedge])
+        error = None
+
+        while len(pending) > 0:
+            done, pending = futures.wait(
+                pending, return_when=futures.FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    resp = future.result()
+                except PoolTimeoutError as e:
+                    if future is primary:
+                        error = e
+                    continue # no free session for the hedge
+                except Exception as e:
+                    error = e
+                    continue
+
+                if future is hedge:
+                    logging.debug('hedged %s won' % method)
+                    with self.lock:
+                        self.hedge_wins = self.hedge_wins + 1
+
+                return resp
+
+        raise error
+
+    def stats(self):
+        ''' Returns hedging metrics '''
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'hedge_rate': self.hedges / self.calls if self.calls else 0.0,
+                'hedge_delay': self.hedge_delay()
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=True)
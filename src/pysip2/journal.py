@@ -0,0 +1,373 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Offline circulation.
+
+While the ACS is unreachable, checkouts and checkins are written to a
+local SQLite journal (WAL mode) and acknowledged locally.  Once a 99 SC
+Status shows the ACS online again, the journal is flushed through a
+ClientPool with no_block=Y and the original transaction dates.
+
+Each journal entry is sent at most once.  An entry is marked 'sending'
+and committed before its request goes out.  Only then is it marked
+'done' or 'conflict' from the ACS response.  If the connection drops
+mid-request, the entry stays 'sending', because nobody knows whether
+the ACS applied it.  Such entries are listed in the conflict report for
+an operator to resolve, and are not resent blindly.  The same goes for
+an online checkout or checkin whose connection fails after the request
+may have been written: it is journaled as 'sending', not 'pending'.
+
+Offline checkouts without an nb_due_date are due loan_period after the
+offline transaction.
+
+    circ = OfflineCirculation(pool, OfflineJournal('offline.db'))
+    resp = circ.checkout(item_id, patron_id)  # None when journaled
+    ...
+    circ.flush_if_online()
+    circ.journal.write_report(sys.stdout)
+'''
+import csv, time, datetime, logging, sqlite3, threading
+import concurrent.futures as futures
+from pysip2.message import Message
+from pysip2.dates import format_sipdate, parse_sipdate
+from pysip2.limits import ACSOverloadedError
+from pysip2.pool import PoolTimeoutError
+
+PENDING = 'pending'
+SENDING = 'sending'
+DONE = 'done'
+CONFLICT = 'conflict'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS transactions (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind        TEXT NOT NULL,      -- checkout, checkin
+    item_id     TEXT NOT NULL,
+    patron_id   TEXT,               -- checkout only
+    location    TEXT,               -- checkin current location
+    institution TEXT,
+    txn_date    TEXT NOT NULL,      -- SIP2 date of the offline transaction
+    due_date    TEXT,               -- checkout nb_due_date
+    state       TEXT NOT NULL DEFAULT 'pending',
+    screen_msg  TEXT,
+    response    TEXT,
+    sent_time   REAL
+);
+CREATE INDEX IF NOT EXISTS transactions_state ON transactions (state);
+'''
+
+REPORT_COLUMNS = ('id', 'kind', 'item_id', 'patron_id', 'location',
+    'txn_date', 'state', 'screen_msg', 'response')
+
+class OfflineJournal(object):
+    ''' SQLite journal of offline checkouts and checkins '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # WAL + NORMAL survives a process crash and only risks the
+        # latest commits on power loss, at a fraction of the fsyncs
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def record(self, kind, item_id, **kwargs):
+        ''' Journals a transaction.  Returns its id.
+
+        kwargs: patron_id, location, institution, due_date, txn_date,
+            state (default pending)
+        '''
+        with self.lock, self.db:
+            cur = self.db.execute(
+                'INSERT INTO transactions (kind, item_id, patron_id, '
+                'location, institution, txn_date, due_date, state) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                kind, item_id, kwargs.get('patron_id'),
+                kwargs.get('location'), kwargs.get('institution'),
+                kwargs.get('txn_date') or Message.sipdate(),
+                kwargs.get('due_date'), kwargs.get('state', PENDING)))
+            return cur.lastrowid
+
+    def pending(self, limit=None):
+        ''' Returns pending entries, oldest first '''
+        sql = 'SELECT * FROM transactions WHERE state = ? ORDER BY id'
+        if limit is not None:
+            sql = sql + ' LIMIT %d' % limit
+        with self.lock:
+            return self.db.execute(sql, (PENDING,)).fetchall()
+
+    def set_state(self, entry_id, state, from_state, **kwargs):
+        ''' Moves an entry from from_state to state.  Returns False if
+        the entry was not in from_state.
+        '''
+        with self.lock, self.db:
+            cur = self.db.execute(
+                'UPDATE transactions SET state = ?, '
+                'screen_msg = COALESCE(?, screen_msg), '
+                'response = COALESCE(?, response), '
+                'sent_time = COALESCE(?, sent_time) '
+                'WHERE id = ? AND state = ?', (
+                state, kwargs.get('screen_msg'), kwargs.get('response'),
+                kwargs.get('sent_time'), entry_id, from_state))
+            return cur.rowcount == 1
+
+    def retry_in_doubt(self):
+        ''' Returns entries left in 'sending' to 'pending'.  Only call
+        this once it is known the ACS did not apply them.
+        '''
+        with self.lock, self.db:
+            return self.db.execute(
+                'UPDATE transactions SET state = ? WHERE state = ?',
+                (PENDING, SENDING)).rowcount
+
+    def counts(self):
+        ''' Returns {state: entry count} '''
+        with self.lock:
+            return dict(self.db.execute(
+                'SELECT state, COUNT(*) FROM transactions GROUP BY state'))
+
+    def conflicts(self):
+        ''' Entries the ACS refused, or that may or may not have been
+        applied.
+        '''
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM transactions WHERE state IN (?, ?) '
+                'ORDER BY id', (CONFLICT, SENDING)).fetchall()
+
+    def write_report(self, out):
+        ''' Writes the conflict report as CSV to a file object '''
+        writer = csv.writer(out)
+        writer.writerow(REPORT_COLUMNS)
+        for row in self.conflicts():
+            writer.writerow([row[c] for c in REPORT_COLUMNS])
+
+    def close(self):
+        self.db.close()
+
+
+class OfflineCirculation(object):
+    ''' Checkout and checkin through a ClientPool, falling back to an
+    OfflineJournal while the ACS is unavailable.
+    '''
+
+    def __init__(self, pool, journal, **kwargs):
+        '''
+        kwargs:
+            require_offline_ok : only flush when the 98 ACS Status
+                reports offline ok = Y.  Default True.
+            batch_size : entries read from the journal per flush pass.
+                Default 500.
+            workers : parallel flush requests.  Default pool.size.
+            loan_period : datetime.timedelta from an offline checkout
+                to its due date, used when no nb_due_date is given.
+                Default 14 days.
+        '''
+        self.pool = pool
+        self.journal = journal
+        self.require_offline_ok = kwargs.get('require_offline_ok', True)
+        self.batch_size = kwargs.get('batch_size', 500)
+        self.workers = kwargs.get('workers', pool.size)
+        self.loan_period = kwargs.get('loan_period', datetime.timedelta(14))
+        self.offline = False
+        self.flush_lock = threading.Lock()
+
+    def go_offline(self, reason):
+        if not self.offline:
+            logging.warn('ACS unavailable, journaling transactions: %s'
+                % reason)
+        self.offline = True
+
+    def checkout(self, item_id, patron_id, **kwargs):
+        ''' Returns the 12 Checkout Response, or None if the checkout
+        was journaled.
+
+        kwargs: institution, nb_due_date.  Other kwargs are passed to
+        Client.checkout_request() when online.
+        '''
+        state = PENDING
+        if not self.offline:
+            resp, state = self.call_online(
+                'checkout_request', item_id, patron_id, **kwargs)
+            if resp is not None:
+                return resp
+
+        txn_date = Message.sipdate()
+        self.journal.record('checkout', item_id, patron_id=patron_id,
+            institution=kwargs.get('institution'), txn_date=txn_date,
+            due_date=format_sipdate(kwargs.get('nb_due_date')) or
+                self.due_date(txn_date), state=state)
+        return None
+
+    def checkin(self, item_id, location, **kwargs):
+        ''' Returns the 10 Checkin Response, or None if the checkin
+        was journaled.
+
+        kwargs: institution.  Other kwargs are passed to
+        Client.checkin_request() when online.
+        '''
+        state = PENDING
+        if not self.offline:
+            resp, state = self.call_online(
+                'checkin_request', item_id, location, **kwargs)
+            if resp is not None:
+                return resp
+
+        self.journal.record('checkin', item_id, location=location,
+            institution=kwargs.get('institution'), state=state)
+        return None
+
+    def call_online(self, method, *args, **kwargs):
+        ''' Returns (response, None), or (None, journal state) if the
+        ACS could not be used.  The state is 'pending' when the request
+        was certainly not written, and 'sending' when it may have been.
+        '''
+        attempted = False
+        try:
+            with self.pool.client() as client:
+                attempted = True
+                return self.pool.run(client, method, *args, **kwargs), None
+        except (ACSOverloadedError, PoolTimeoutError) as e:
+            # refused by the pool, guard or rate limiter before sending
+            failure = e
+            state = PENDING
+        except (IOError, OSError) as e:
+            failure = e
+            state = SENDING if attempted else PENDING
+
+        self.go_offline(failure)
+        if state == SENDING:
+            logging.warn('%s failed after it may have been sent; '
+                'journaling it as in doubt' % method)
+        return None, state
+
+    def due_date(self, txn_date):
+        ''' Due date for an offline checkout made at txn_date '''
+        return format_sipdate(parse_sipdate(txn_date) + self.loan_period)
+
+    def acs_online(self):
+        ''' Sends a 99 SC Status.  True if the ACS is online and, when
+        required, accepts offline transactions.
+        '''
+        try:
+            view = self.pool.call('sc_status').view()
+        except (IOError, OSError, ACSOverloadedError) as e:
+            logging.info('ACS status check failed: %s' % e)
+            return False
+
+        if not view.online_status:
+            return False
+
+        if self.require_offline_ok and not view.offline_ok:
+            logging.warn('ACS is online but does not accept '
+                'offline transactions; leaving journal unflushed')
+            return False
+
+        return True
+
+    def flush_if_online(self):
+        ''' Flushes the journal if the ACS is back.  Returns the number
+        of entries sent, or None if the ACS is unavailable.
+        '''
+        if not self.acs_online():
+            return None
+        sent = self.flush()
+        if self.journal.counts().get(PENDING, 0) == 0:
+            self.offline = False
+        return sent
+
+    def flush(self):
+        ''' Sends pending journal entries with no_block=Y.
+
+        Entries for the same item are sent in journal order; different
+        items go in parallel.  Stops at the first I/O failure.
+        '''
+        sent = 0
+        with self.flush_lock, futures.ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix='sip-flush') as executor:
+            while True:
+                rows = self.journal.pending(self.batch_size)
+                if len(rows) == 0:
+                    break
+
+                by_item = {}
+                for row in rows:
+                    by_item.setdefault(row['item_id'], []).append(row)
+
+                jobs = [executor.submit(self.flush_entries, entries)
+                    for entries in by_item.values()]
+
+                failed = None
+                for job in jobs:
+                    try:
+                        sent = sent + job.result()
+                    except (IOError, OSError, ACSOverloadedError,
+                            PoolTimeoutError) as e:
+                        failed = e
+
+                if failed is not None:
+                    self.go_offline(failed)
+                    break
+
+        logging.info('Flushed %d offline transactions' % sent)
+        return sent
+
+    def flush_entries(self, entries):
+        ''' Sends the entries for one item in order '''
+        sent = 0
+        for row in entries:
+            # a client that can't be had (refused, login failure, pool
+            # timeout) leaves the entry pending
+            with self.pool.client() as client:
+                if not self.journal.set_state(row['id'], SENDING, PENDING,
+                        sent_time=time.time()):
+                    continue # claimed elsewhere
+
+                try:
+                    resp = self.send_entry(client, row)
+                except ACSOverloadedError:
+                    # refused by the guard or rate limiter before the
+                    # request was written; safe to send again later
+                    self.journal.set_state(row['id'], PENDING, SENDING)
+                    raise
+
+            sent = sent + 1
+            view = resp.view()
+            self.journal.set_state(row['id'],
+                DONE if view.ok else CONFLICT, SENDING,
+                screen_msg=resp.get_field_value('AF'),
+                response=str(resp).rstrip())
+        return sent
+
+    def send_entry(self, client, row):
+        if row['kind'] == 'checkout':
+            return self.pool.run(client, 'checkout_request',
+                row['item_id'], row['patron_id'], no_block='Y',
+                transaction_date=row['txn_date'],
+                nb_due_date=row['due_date'] or self.due_date(row['txn_date']),
+                **self.institution(row))
+
+        return self.pool.run(client, 'checkin_request',
+            row['item_id'], row['location'], no_block='Y',
+            transaction_date=row['txn_date'],
+            return_date=row['txn_date'], **self.institution(row))
+
+    def institution(self, row):
+        if row['institution']:
+            return {'institution': row['institution']}
+        return {}
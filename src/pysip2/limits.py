@@ -0,0 +1,369 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Overload protection for ACS calls.
+
+AdaptiveLimiter caps in-flight requests per ACS endpoint, adjusting the
+cap with AIMD (additive increase, multiplicative decrease) based on
+observed request latency.  CircuitBreaker stops sending requests after
+consecutive failures and probes the ACS with SC Status before resuming.
+Guard combines the two around Client calls.  Callers get an
+ACSOverloadedError right away instead of waiting on a struggling ACS.
+
+RateLimiter applies token buckets per ACS endpoint and message code, so
+bulk jobs can be held to a fixed request rate.
+'''
+import time, logging, threading
+
+class ACSOverloadedError(Exception):
+    ''' The ACS is overloaded or unavailable; the request was not sent '''
+    pass
+
+class RateLimitedError(ACSOverloadedError):
+    ''' A rate limit was reached and the caller chose not to wait '''
+    pass
+
+class ProbeFailedError(ACSOverloadedError, IOError):
+    ''' The circuit breaker's probe request failed.  Also an IOError,
+    since the probing client may be left with an unread reply or a
+    dead connection and must not be reused.
+    '''
+    pass
+
+class AdaptiveLimiter(object):
+    ''' AIMD concurrency limit for one ACS endpoint '''
+
+    def __init__(self, **kwargs):
+        '''
+        kwargs:
+            initial_limit : starting in-flight limit.  Default 4.
+            min_limit : the limit never drops below this.  Default 1.
+            max_limit : the limit never grows past this.  Default 64.
+            latency_target : seconds.  Slower responses count as a
+                congestion signal.  Default 1.0
+            backoff : multiplier applied to the limit on congestion or
+                failure.  Default 0.5
+            wait_timeout : seconds acquire() waits for a free slot
+                before raising ACSOverloadedError.  Default 0.
+        '''
+        self.min_limit = kwargs.get('min_limit', 1)
+        self.max_limit = kwargs.get('max_limit', 64)
+        self.limit = float(kwargs.get('initial_limit', 4))
+        self.latency_target = kwargs.get('latency_target', 1.0)
+        self.backoff = kwargs.get('backoff', 0.5)
+        self.wait_timeout = kwargs.get('wait_timeout', 0)
+        self.inflight = 0
+        self.rejected = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        ''' Claims an in-flight slot or raises ACSOverloadedError '''
+        with self.cond:
+            deadline = time.time() + self.wait_timeout
+            while self.inflight >= int(self.limit):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.rejected = self.rejected + 1
+                    raise ACSOverloadedError(
+                        'ACS overloaded: %d requests in flight (limit %d)' % (
+                        self.inflight, int(self.limit)))
+                self.cond.wait(remaining)
+            self.inflight = self.inflight + 1
+
+    def release(self, latency=None, failed=False):
+        ''' Returns a slot and adjusts the limit from the outcome '''
+        with self.cond:
+            self.inflight = self.inflight - 1
+
+            if failed or (latency is not None and
+                    latency > self.latency_target):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                logging.debug('ACS limit decreased to %.2f' % self.limit)
+            else:
+                # +1 per limit's worth of successful requests
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.cond.notify()
+
+
+class CircuitBreaker(object):
+    ''' Opens after consecutive failures.  Once reset_timeout has passed
+    a single probe request decides whether to close again.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, **kwargs):
+        '''
+        kwargs:
+            failure_threshold : consecutive failures that open the
+                breaker.  Default 5.
+            reset_timeout : seconds the breaker stays open before
+                probing.  Default 30.
+        '''
+        self.failure_threshold = kwargs.get('failure_threshold', 5)
+        self.reset_timeout = kwargs.get('reset_timeout', 30)
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_time = 0
+        self.lock = threading.Lock()
+
+    def before_call(self, probe):
+        ''' Raises ACSOverloadedError unless a call may proceed.
+
+        probe is a function that sends a cheap request (SC Status) and
+        raises on failure.  It is only called in the half-open state.
+        '''
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            if self.state == CircuitBreaker.HALF_OPEN or \
+                    time.time() - self.opened_time < self.reset_timeout:
+                raise ACSOverloadedError('ACS circuit breaker is open')
+            # this caller gets to probe; everyone else is refused
+            self.state = CircuitBreaker.HALF_OPEN
+
+        try:
+            probe()
+        except Exception as e:
+            logging.info('ACS probe failed: %s' % e)
+            self.trip()
+            raise ProbeFailedError('ACS circuit breaker is open') from e
+
+        logging.info('ACS probe succeeded; closing circuit breaker')
+        self.record_success()
+
+    def trip(self):
+        with self.lock:
+            self.state = CircuitBreaker.OPEN
+            self.opened_time = time.time()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = CircuitBreaker.CLOSED
+
+    def record_failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.failures < self.failure_threshold:
+                return
+        logging.warn('%d consecutive ACS failures; opening circuit breaker'
+            % self.failures)
+        self.trip()
+
+
+class Guard(object):
+    ''' Runs Client calls under an AdaptiveLimiter and CircuitBreaker.
+    Either may be None.
+    '''
+
+    def __init__(self, limiter=None, breaker=None):
+        self.limiter = limiter
+        self.breaker = breaker
+
+    def call(self, client, method, *args, **kwargs):
+        ''' Calls client.<method>(*args, **kwargs), e.g.
+        guard.call(client, 'item_info_request', barcode)
+        '''
+
+        if self.breaker is not None:
+            self.breaker.before_call(lambda: client.sc_status())
+
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+        log = client.client_log
+        count = log.finished
+        latency = None
+        failed = False
+
+        try:
+            resp = getattr(client, method)(*args, **kwargs)
+        except (IOError, OSError):
+            # only I/O errors say anything about the ACS
+            failed = True
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        finally:
+            # round-trip time as recorded by the ClientLog
+            if not failed and log.finished > count:
+                latency = log.messages[-1].duration
+            # the slot is returned whatever the call raised
+            if self.limiter is not None:
+                self.limiter.release(latency, failed=failed)
+
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+        return resp
+
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+class TokenBucket(object):
+    ''' Token bucket refilled at rate tokens per second, holding at
+    most burst tokens.
+
+    Batch callers only take tokens that are left over above a reserve
+    kept for interactive callers, and they yield to any interactive
+    caller that is waiting.
+    '''
+
+    def __init__(self, rate, burst, batch_reserve=0.5):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        # tokens a batch caller needs before it may take one
+        self.batch_threshold = 1 + batch_reserve * (self.burst - 1)
+        self.interactive_waiting = 0
+        self.cond = threading.Condition()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, priority=INTERACTIVE, block=True, timeout=None):
+        ''' Takes one token.  Returns True on success, False if the
+        token could not be had without blocking or within timeout.
+        '''
+        interactive = priority != BATCH
+        needed = 1 if interactive else self.batch_threshold
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.cond:
+            if interactive:
+                self.interactive_waiting = self.interactive_waiting + 1
+
+            try:
+                while True:
+                    self.refill()
+
+                    if self.tokens >= needed and \
+                            (interactive or self.interactive_waiting == 0):
+                        self.tokens = self.tokens - 1
+                        return True
+
+                    if not block:
+                        return False
+
+                    wait = max(0.001, (needed - self.tokens) / self.rate)
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait = min(wait, remaining)
+
+                    self.cond.wait(wait)
+            finally:
+                if interactive:
+                    self.interactive_waiting = self.interactive_waiting - 1
+                    self.cond.notify_all()
+
+    def give_back(self):
+        ''' Returns an unused token '''
+        with self.cond:
+            self.tokens = min(self.burst, self.tokens + 1)
+            self.cond.notify_all()
+
+
+class RateLimiter(object):
+    ''' Token-bucket rate limits keyed by ACS endpoint and message code.
+
+    Attach to a Client with client.rate_limit(limiter) or to every
+    client of a ClientPool with its rate_limiter kwarg.
+
+        # 5 item info requests per second, bursts of 10, and 50
+        # messages per second overall, per endpoint.
+        limiter = RateLimiter(rates={'17': (5, 10)}, endpoint_rate=(50, 50))
+    '''
+
+    def __init__(self, **kwargs):
+        '''
+        kwargs:
+            rates : {message code: (rate, burst)}.  Rate is messages
+                per second.
+            default_rate : (rate, burst) for codes not in rates.
+                Default None, no per-code limit.
+            endpoint_rate : (rate, burst) across all messages sent to
+                one endpoint.  Default None, no limit.
+            batch_reserve : fraction of each bucket's burst that batch
+                callers leave for interactive callers.  Default 0.5
+            block : wait for a token by default.  Default True.
+            timeout : seconds to wait for a token when blocking.
+                Default None, wait as long as needed.
+        '''
+        self.rates = kwargs.get('rates', {})
+        self.default_rate = kwargs.get('default_rate')
+        self.endpoint_rate = kwargs.get('endpoint_rate')
+        self.batch_reserve = kwargs.get('batch_reserve', 0.5)
+        self.block = kwargs.get('block', True)
+        self.timeout = kwargs.get('timeout')
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, endpoint, code):
+        ''' Returns the bucket for endpoint + code, or for the endpoint
+        as a whole when code is None.  None means no limit applies.
+        '''
+        key = (endpoint, code)
+        with self.lock:
+            if key not in self.buckets:
+                if code is None:
+                    rate = self.endpoint_rate
+                else:
+                    rate = self.rates.get(code, self.default_rate)
+                self.buckets[key] = None if rate is None else \
+                    TokenBucket(rate[0], rate[1], self.batch_reserve)
+            return self.buckets[key]
+
+    def acquire(self, endpoint, code, priority=INTERACTIVE,
+            block=None, timeout=None):
+        ''' Waits for permission to send one message, or raises
+        RateLimitedError.
+        '''
+        if block is None:
+            block = self.block
+        if timeout is None:
+            timeout = self.timeout
+
+        code_bucket = self.bucket(endpoint, code)
+        if code_bucket is not None and \
+                not code_bucket.take(priority, block, timeout):
+            raise RateLimitedError(
+                'Rate limit reached for %s message %s' % (endpoint, code))
+
+        endpoint_bucket = self.bucket(endpoint, None)
+        if endpoint_bucket is not None and \
+                not endpoint_bucket.take(priority, block, timeout):
+            if code_bucket is not None:
+                code_bucket.give_back()
+            raise RateLimitedError('Rate limit reached for %s' % endpoint)
+
+    def release(self, endpoint, code):
+        ''' Returns the tokens taken by acquire() for a message that
+        was not sent after all.
+        '''
+        for bucket in (self.bucket(endpoint, code),
+                self.bucket(endpoint, None)):
+            if bucket is not None:
+                bucket.give_back()
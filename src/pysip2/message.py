@@ -18,6 +18,68 @@ from pysip2.spec import MessageSpec as mspec
 from pysip2.spec import FieldSpec as fspec
 from pysip2.spec import FixedFieldSpec as ffspec
 from pysip2.spec import STRING_COLUMN_PAD, SIP_DATETIME, LINE_TERMINATOR
+from pysip2.spec import TEXT_ENCODING
+from pysip2 import views
+from pysip2.dates import sip_clock, parse_sipdate
+
+# to_wire() framing.  ASCII group/record separators never appear in
+# SIP2 message text.
+WIRE_FIELDS = 1
+WIRE_RAW = 2
+WIRE_GROUP = '\x1d'
+WIRE_RECORD = '\x1e'
+
+class InternTable(object):
+    '''Shares one string object per distinct value of low-cardinality
+    fields, so large sets of parsed messages don't hold millions of
+    copies of the same institution or location string.
+
+    Install one for all parsing with Message.intern_table = InternTable()
+    or per Client with client.intern_table.
+    '''
+
+    # fields whose values repeat across most messages
+    FIELD_CODES = ('AO', 'AP', 'AQ', 'BH', 'BT', 'CK', 'CL', 'CR', 'CT')
+    FIXED_FIELDS = ('language', 'circ_status', 'security_marker',
+        'fee_type', 'currency_type', 'patron_status', 'hold_items_count',
+        'overdue_items_count', 'charged_items_count', 'fine_items_count',
+        'recall_items_count', 'unavail_holds_count')
+
+    def __init__(self, field_codes=FIELD_CODES, fixed_fields=FIXED_FIELDS,
+            max_size=100000):
+        '''
+        field_codes : variable field codes whose values are interned
+        fixed_fields : names of fixed fields whose values are interned
+        max_size : stop adding values past this many, in case a field
+            turns out not to be low-cardinality.
+        '''
+        self.field_codes = frozenset(field_codes)
+        self.fixed_fields = frozenset(fixed_fields)
+        self.max_size = max_size
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, value):
+        shared = self.values.get(value)
+        if shared is not None:
+            self.hits = self.hits + 1
+            return shared
+        self.misses = self.misses + 1
+        if len(self.values) < self.max_size:
+            self.values[value] = value
+        return value
+
+    def stats(self):
+        '''Returns hit/miss counts and the hit rate'''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.values),
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
 
 class Field(object):
     '''Models a single SIP2 message field'''
@@ -25,6 +87,17 @@ class Field(object):
     def __init__(self, spec, value=''):
         self.spec = spec
         self.value = value
+
+    @property
+    def datetime(self):
+        '''The value as a timezone-aware datetime, or None if the value
+        is not a SIP2 date.  Computed on first access.
+        '''
+        # re-parse only if the value has been replaced since last time
+        if getattr(self, '_datetime_src', Field) is not self.value:
+            self._datetime = parse_sipdate(self.value)
+            self._datetime_src = self.value
+        return self._datetime
     
     def __str__(self):
         return self.spec.code + (self.value or '') + '|'
@@ -46,11 +119,19 @@ class FixedField(Field):
 class Message(object):
     '''Models a complete SIP2 message.'''
 
+    # InternTable applied by parse_txt(); may be passed per message as
+    # the intern_table kwarg.
+    intern_table = None
+
+    # Optional collection of field codes.  When set, parse_txt() only
+    # builds Fields for these codes; the full text stays in msg_txt.
+    only_fields = None
 
     def __init__(self, **kwargs):
         self.fields = []
         self.fixed_fields = []
         self.msg_txt = ''
+        self.msg_bytes = None
 
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -76,6 +157,105 @@ class Message(object):
 
         return self.msg_txt
 
+    def to_bytes(self):
+        '''Returns the encoded, line-terminated message ready for
+        writing to the socket.
+
+        The encoded frame is cached, so re-sending a message does not
+        encode it again.
+        '''
+
+        if self.msg_bytes is None:
+            txt = str(self)
+            if txt[-len(LINE_TERMINATOR):] != LINE_TERMINATOR:
+                txt = txt + LINE_TERMINATOR
+            self.msg_bytes = txt.encode(TEXT_ENCODING)
+
+        return self.msg_bytes
+
+    def keeps_raw(self):
+        '''True if the fields don't hold the whole message, so it
+        must be serialized as text.
+        '''
+        return not self.spec.known or \
+            (self.only_fields is not None and self.msg_txt != '')
+
+    def to_dict(self):
+        '''Returns the message as a dict of plain strings and lists,
+        suitable for JSON or msgpack:
+
+            {'code': '64', 'fixed': [values], 'fields': [[code, value]]}
+
+        Specs are referenced by code.  Messages with an unknown code,
+        or parsed with only_fields, carry their text as 'raw' instead of
+        'fixed' and 'fields'.
+        '''
+        if self.keeps_raw():
+            return {'code': self.spec.code, 'raw': self.msg_txt}
+
+        return {
+            'code': self.spec.code,
+            'fixed': [f.value or '' for f in self.fixed_fields],
+            'fields': [[f.spec.code, f.value or ''] for f in self.fields]
+        }
+
+    @staticmethod
+    def from_dict(data):
+        '''Builds a Message from the output of to_dict()'''
+        if 'raw' in data:
+            return Message(msg_txt = data['raw'])
+
+        spec = mspec.registry[data['code']]
+        msg = Message(spec = spec)
+        msg.fixed_fields = [FixedField(s, v)
+            for s, v in zip(spec.fixed_fields, data['fixed'])]
+        find = fspec.find_by_code
+        msg.fields = [Field(find(c), v) for c, v in data['fields']]
+        return msg
+
+    def to_wire(self):
+        '''Returns a compact bytes encoding of the message for IPC and
+        caches.  Unlike pickle, it holds no spec objects, and unlike the
+        SIP2 frame it is loaded without re-parsing the message text.
+        '''
+        if self.keeps_raw():
+            return bytes((WIRE_RAW,)) + self.msg_txt.encode(TEXT_ENCODING)
+
+        txt = self.spec.code + WIRE_GROUP \
+            + WIRE_RECORD.join([f.value or '' for f in self.fixed_fields]) \
+            + WIRE_GROUP + WIRE_RECORD.join(
+                [f.spec.code + (f.value or '') for f in self.fields])
+
+        if txt.count(WIRE_GROUP) != 2:
+            raise ValueError(_("Message contains a reserved character"))
+
+        return bytes((WIRE_FIELDS,)) + txt.encode(TEXT_ENCODING)
+
+    @staticmethod
+    def from_wire(data):
+        '''Builds a Message from the output of to_wire()'''
+        txt = bytes(data[1:]).decode(TEXT_ENCODING)
+        if data[0] == WIRE_RAW:
+            return Message(msg_txt = txt)
+        if data[0] != WIRE_FIELDS:
+            raise ValueError(_("Unknown wire format {0}").format(data[0]))
+
+        code, fixed, fields = txt.split(WIRE_GROUP)
+        spec = mspec.registry[code]
+        msg = Message(spec = spec)
+        if fixed:
+            msg.fixed_fields = [FixedField(s, v) for s, v
+                in zip(spec.fixed_fields, fixed.split(WIRE_RECORD))]
+        if fields:
+            find = fspec.find_by_code
+            msg.fields = [Field(find(part[:2]), part[2:])
+                for part in fields.split(WIRE_RECORD)]
+        return msg
+
+    def __reduce__(self):
+        # pickle by spec code rather than copying the spec objects
+        return (Message.from_wire, (self.to_wire(),))
+
     def __repr__(self):
 
         # note: this is a less than perfect i18n solution, but
@@ -93,6 +273,11 @@ class Message(object):
             ' '*(STRING_COLUMN_PAD - code_len),
             self.spec.code
         )
+
+        if not self.spec.known:
+            raw_str = _("Raw")
+            return text + raw_str + ' '*(STRING_COLUMN_PAD - len(raw_str)) \
+                + ': ' + self.msg_txt.rstrip(LINE_TERMINATOR)
             
         first = True
         for field in self.fixed_fields:
@@ -121,6 +306,21 @@ class Message(object):
         if value is not None:
             self.fields.append(Field(spec, value))
 
+    def set_field_value(self, code, value):
+        '''Sets the value of the first field with the specified code.
+
+        Returns False if the message has no such field.  Any cached
+        message text is discarded so it is rebuilt from the fields.
+        '''
+        field = self.get_field(code)
+        if field is None:
+            return False
+
+        field.value = value
+        self.msg_txt = ''
+        self.msg_bytes = None
+        return True
+
     def get_field(self, code):
         '''Returns the first Field object with the specified code.
 
@@ -155,11 +355,24 @@ class Message(object):
 
     def get_fixed_field_by_name(self, name):
         '''Returns the FixedField object with the specified name.'''
+        index = self.spec.fixed_field_index(name)
+        if index is not None and index < len(self.fixed_fields):
+            field = self.fixed_fields[index]
+            if field.spec.name == name:
+                return field
+
+        # fixed fields added out of spec order
         if hasattr(ffspec, name):
             spec = getattr(ffspec, name)
             return [f for f in self.fixed_fields if f.spec == spec][0]
         return None
 
+    def view(self):
+        '''Returns a typed view (see pysip2.views) over this message,
+        or None if the message type has no view.
+        '''
+        return views.view_for(str(self))
+
     def parse_txt(self):
 
         # strip the line separator
@@ -167,24 +380,73 @@ class Message(object):
 
         # message type code
         self.spec = mspec.find_by_code(txt[:2])
+        if self.spec is None:
+            # Keep unknown messages as raw text.  Without a spec there
+            # is no way to tell where the fixed fields end.
+            self.spec = mspec.unknown(txt[:2])
+            return
+
         txt = txt[2:]
+        table = self.intern_table
 
         for spec in self.spec.fixed_fields:
             value = txt[:spec.length]
             txt = txt[spec.length:]
+            if table is not None and spec.name in table.fixed_fields:
+                value = table.intern(value)
             self.fixed_fields.append(FixedField(spec, value))
 
         if len(txt) == 0:
             return
 
+        if self.only_fields is not None:
+            self.parse_selected_fields(txt, table)
+            return
+
         parts = txt.split('|')
 
         for part in parts:
             if part == '': break
             field_spec = fspec.find_by_code(part[:2])
             if field_spec is not None:
-                self.fields.append(Field(field_spec, part[2:]))
+                value = part[2:]
+                if table is not None and field_spec.code in table.field_codes:
+                    value = table.intern(value)
+                self.fields.append(Field(field_spec, value))
+
+    def parse_selected_fields(self, txt, table):
+        '''Adds Fields for the codes in only_fields, in message order.
+
+        Every '|' ends a field, so a wanted field is found by searching
+        for '|' + code; other fields are never sliced out of the text.
+        '''
+        found = []
+        for code in self.only_fields:
+            if txt.startswith(code):
+                pos = 0
+            else:
+                pos = txt.find('|' + code)
+                if pos >= 0:
+                    pos = pos + 1
+
+            while pos >= 0:
+                end = txt.find('|', pos)
+                if end < 0:
+                    end = len(txt)
+                value = txt[pos + 2:end]
+                if table is not None and code in table.field_codes:
+                    value = table.intern(value)
+                found.append((pos, code, value))
+
+                pos = txt.find('|' + code, end)
+                if pos >= 0:
+                    pos = pos + 1
+
+        found.sort()
+        for pos, code, value in found:
+            self.fields.append(Field(fspec.find_by_code(code), value))
 
     @staticmethod
     def sipdate():
-        return time.strftime(SIP_DATETIME)
+        '''Returns the current time as a SIP2 date string.'''
+        return sip_clock.now()
@@ -0,0 +1,205 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Client observer hooks.
+
+Subclass Observer, override the events of interest and install it
+with client.observe(observer):
+
+    pre_send(client, msg)        : before a Message is written
+    post_send(client, msg)       : after a Message is written
+    frame_received(client, frame): a complete response frame, as bytes
+    parsed(client, msg)          : the response Message
+    error(client, exc)           : an exception while sending/receiving
+
+A Client only calls the events its observers override, so a client
+without observers does no extra work per message.
+'''
+import logging, threading, collections
+from pysip2.spec import TEXT_ENCODING
+from pysip2.message import Message
+
+EVENTS = ('pre_send', 'post_send', 'frame_received', 'parsed', 'error')
+
+# fields holding patron personal data or credentials
+PII_FIELDS = (
+    'AA', 'AC', 'AD', 'AE', 'BD', 'BE', 'BF', 'CN', 'CO', 'CY', 'DA', 'PB')
+
+class Observer(object):
+    ''' Base class for client observers.  All events are no-ops. '''
+
+    def pre_send(self, client, msg):
+        pass
+
+    def post_send(self, client, msg):
+        pass
+
+    def frame_received(self, client, frame):
+        pass
+
+    def parsed(self, client, msg):
+        pass
+
+    def error(self, client, exc):
+        pass
+
+    def handles(self, event):
+        ''' True if this observer overrides the event '''
+        return getattr(type(self), event) is not getattr(Observer, event)
+
+
+class LoggingObserver(Observer):
+    ''' Logs sent and received messages '''
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger()
+        self.level = level
+
+    def pre_send(self, client, msg):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, 'SENDING: %s' % str(msg))
+
+    def parsed(self, client, msg):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, 'RECEIVED: %s' % str(msg))
+
+    def error(self, client, exc):
+        self.logger.warn('SIP client error: %s' % exc)
+
+
+def redact(msg, codes=PII_FIELDS, mask='***'):
+    ''' Returns a copy of the Message with the values of the listed
+    fields replaced by mask.  msg may also be a received frame as text.
+    '''
+    if isinstance(msg, str):
+        txt = msg
+    else:
+        # to_bytes() adds the terminator parse_txt() expects; outbound
+        # messages don't have one
+        txt = msg.to_bytes().decode(TEXT_ENCODING)
+    copy = Message(msg_txt = txt)
+    for field in copy.fields:
+        if field.spec.code in codes:
+            field.value = mask
+    copy.msg_txt = ''
+    copy.msg_bytes = None
+    return copy
+
+
+class RedactingObserver(Observer):
+    ''' Passes events on to another observer with personal data
+    removed from the messages and frames.
+    '''
+
+    def __init__(self, observer, codes=PII_FIELDS, mask='***'):
+        self.observer = observer
+        self.codes = codes
+        self.mask = mask
+
+    def pre_send(self, client, msg):
+        self.observer.pre_send(client, redact(msg, self.codes, self.mask))
+
+    def post_send(self, client, msg):
+        self.observer.post_send(client, redact(msg, self.codes, self.mask))
+
+    def frame_received(self, client, frame):
+        msg = redact(frame.decode(TEXT_ENCODING), self.codes, self.mask)
+        self.observer.frame_received(client, msg.to_bytes())
+
+    def parsed(self, client, msg):
+        self.observer.parsed(client, redact(msg, self.codes, self.mask))
+
+    def error(self, client, exc):
+        self.observer.error(client, exc)
+
+
+class SamplingObserver(Observer):
+    ''' Passes a random fraction of requests on to another observer.
+
+    A request's pre_send and post_send events are sampled together, as
+    are a response's frame_received and parsed events.  Errors are
+    always passed on.
+    '''
+
+    def __init__(self, observer, rate):
+        import random # only needed once sampling is in use
+        self.random = random.random
+        self.observer = observer
+        self.rate = rate
+        self.send_sampled = False
+        self.recv_sampled = False
+
+    def pre_send(self, client, msg):
+        self.send_sampled = self.random() < self.rate
+        if self.send_sampled:
+            self.observer.pre_send(client, msg)
+
+    def post_send(self, client, msg):
+        if self.send_sampled:
+            self.observer.post_send(client, msg)
+
+    def frame_received(self, client, frame):
+        self.recv_sampled = self.random() < self.rate
+        if self.recv_sampled:
+            self.observer.frame_received(client, frame)
+
+    def parsed(self, client, msg):
+        if self.recv_sampled:
+            self.observer.parsed(client, msg)
+
+    def error(self, client, exc):
+        self.observer.error(client, exc)
+
+
+class MetricsObserver(Observer):
+    ''' Counts messages and bytes by message code, and errors by type.
+    One instance may be shared by many clients.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = collections.Counter()
+        self.received = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def post_send(self, client, msg):
+        with self.lock:
+            self.sent[msg.spec.code] += 1
+            self.bytes_sent = self.bytes_sent + len(msg.to_bytes())
+
+    def frame_received(self, client, frame):
+        with self.lock:
+            self.bytes_received = self.bytes_received + len(frame)
+
+    def parsed(self, client, msg):
+        with self.lock:
+            self.received[msg.spec.code] += 1
+
+    def error(self, client, exc):
+        with self.lock:
+            self.errors[type(exc).__name__] += 1
+
+    def stats(self):
+        ''' Returns a dict of the collected counts '''
+        with self.lock:
+            return {
+                'sent': dict(self.sent),
+                'received': dict(self.received),
+                'errors': dict(self.errors),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received
+            }
@@ -0,0 +1,284 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Streaming checkin pipeline for automated materials handling (AMH).
+
+Barcodes are read from any iterable (stdin, a file, a queue) and checked
+in over a ClientPool with a bounded number of requests in flight.
+Reading stops while the limit is reached, so a slow ACS pushes back on
+the sorter instead of queueing without bound.  One result dict per item
+is passed to an emit function, optionally in input order.
+
+    echo 31234000123456 | PYTHONPATH=src python3 src/pysip2/pipeline.py \\
+        -c pysip2-client.ini -l SORTER1
+'''
+import sys, json, time, logging, threading
+import logging.config, getopt, configparser
+import concurrent.futures as futures
+from gettext import gettext as _
+from pysip2.config import client_factory
+from pysip2.pool import ClientPool
+
+def iter_queue(q, sentinel=None):
+    ''' Yields items from a queue.Queue until sentinel is received '''
+    while True:
+        item = q.get()
+        if item is sentinel:
+            return
+        yield item
+
+class CheckinPipeline(object):
+    ''' Checks in a stream of barcodes through a ClientPool '''
+
+    def __init__(self, pool, location, **kwargs):
+        '''
+        location : current location sent with each checkin
+
+        kwargs:
+            max_inflight : checkin requests in flight at once.
+                Default pool.size.
+            ordered : emit results in input order.  Default False.
+            report_interval : seconds between throughput/lag log
+                lines.  0 disables.  Default 60.
+            checkin_args : extra kwargs for Client.checkin_request()
+        '''
+        self.pool = pool
+        self.location = location
+        self.max_inflight = kwargs.get('max_inflight', pool.size)
+        self.ordered = kwargs.get('ordered', False)
+        self.report_interval = kwargs.get('report_interval', 60)
+        self.checkin_args = kwargs.get('checkin_args', {})
+
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.completed = 0
+        self.errors = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_report = 0
+
+    def checkin(self, seq, barcode, read_time):
+        result = {'seq': seq, 'barcode': barcode}
+        try:
+            resp = self.pool.call('checkin_request',
+                barcode, self.location, **self.checkin_args)
+            view = resp.view()
+            result.update({
+                'ok': view.ok,
+                'alert': view.alert,
+                'alert_type': resp.get_field_value('CV'),
+                'destination': resp.get_field_value('CT'),
+                'permanent_location': resp.get_field_value('AQ'),
+                'sort_bin': resp.get_field_value('CL'),
+                'screen_msg': resp.get_field_value('AF')
+            })
+        except Exception as e:
+            result.update({'ok': False, 'error': str(e)})
+
+        result['latency'] = round(time.time() - read_time, 6)
+        return result
+
+    def record(self, result, read_time):
+        ''' Sets the result's lag, from reading the barcode to emitting
+        the result, and updates statistics.  Caller holds the lock.
+        '''
+        result['lag'] = round(time.time() - read_time, 6)
+        self.completed = self.completed + 1
+        if 'error' in result:
+            self.errors = self.errors + 1
+        self.total_lag = self.total_lag + result['lag']
+        self.max_lag = max(self.max_lag, result['lag'])
+
+        now = time.time()
+        if self.report_interval and \
+                now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.log_stats()
+
+    def run(self, barcodes, emit):
+        ''' Checks in every barcode, calling emit(result) for each.
+        Blank lines are skipped.  Returns stats() when the input is
+        exhausted and all requests have completed.
+
+        If emit() raises (e.g. BrokenPipeError once the output is
+        closed), no more barcodes are read or emitted, and the error
+        is raised when the requests in flight have completed.
+        '''
+        slots = threading.Semaphore(self.max_inflight)
+        read_times = {} # seq => time the barcode was read
+        waiting = {} # seq => result, for ordered output
+        next_seq = [0]
+        failed = [] # the first emit() error
+        self.start_time = self.last_report = time.time()
+
+        def deliver(result):
+            ''' Records and emits one result, then frees its slot.
+            Caller holds the lock.
+            '''
+            try:
+                self.record(result, read_times.pop(result['seq']))
+                if not failed:
+                    emit(result)
+            except Exception as e:
+                logging.error('Emitting checkin result failed: %s' % e)
+                failed.append(e)
+            finally:
+                slots.release()
+
+        def done(future):
+            result = future.result()
+            with self.lock:
+                if not self.ordered:
+                    deliver(result)
+                    return
+
+                # a slot is only freed once its result is emitted, so
+                # the reorder buffer never exceeds max_inflight
+                waiting[result['seq']] = result
+                while next_seq[0] in waiting:
+                    result = waiting.pop(next_seq[0])
+                    next_seq[0] = next_seq[0] + 1
+                    deliver(result)
+
+        with futures.ThreadPoolExecutor(max_workers=self.max_inflight,
+                thread_name_prefix='sip-checkin') as executor:
+            seq = 0
+            for barcode in barcodes:
+                barcode = barcode.strip()
+                if not barcode:
+                    continue
+                slots.acquire() # backpressure
+                if failed:
+                    slots.release()
+                    break
+                read_time = time.time()
+                with self.lock:
+                    read_times[seq] = read_time
+                executor.submit(self.checkin,
+                    seq, barcode, read_time).add_done_callback(done)
+                seq = seq + 1
+
+        if failed:
+            raise failed[0]
+
+        return self.stats()
+
+    def stats(self):
+        ''' Returns throughput and lag statistics '''
+        elapsed = time.time() - (self.start_time or time.time())
+        return {
+            'completed': self.completed,
+            'errors': self.errors,
+            'throughput': self.completed / elapsed if elapsed else 0.0,
+            'avg_lag': self.total_lag / self.completed \
+                if self.completed else 0.0,
+            'max_lag': self.max_lag
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(_('checkins={0} errors={1} rate={2:.2f}/s '
+            'avg_lag={3:.3f} max_lag={4:.3f}').format(
+            stats['completed'], stats['errors'], stats['throughput'],
+            stats['avg_lag'], stats['max_lag']))
+
+
+def usage(exit_code=0):
+    print(_('''
+    Reads item barcodes, one per line, checks them in and writes one
+    JSON result per line to stdout.
+
+    -h, --help
+        Display this help message
+
+    -c <file>, --config <file>
+        Override the default configuration file.  The default file is
+        'pysip2-client.ini' in the current working directory.
+
+    -f <file>, --file <file>
+        Read barcodes from this file instead of stdin.
+
+    -l <location>, --location <location>
+        Current location sent with each checkin.  Defaults to the
+        location_code from the configuration file.
+
+    -n <count>, --inflight <count>
+        Checkin requests in flight at once.  Defaults to the number of
+        sessions.
+
+    -s <count>, --sessions <count>
+        SIP sessions to open.  Default 4.
+
+    -o, --ordered
+        Write results in input order.
+    '''))
+    sys.exit(exit_code)
+
+def main():
+    configfile = 'pysip2-client.ini'
+    infile = None
+    location = None
+    inflight = None
+    sessions = 4
+    ordered = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:f:l:n:s:o",
+            ["help", "config=", "file=", "location=", "inflight=",
+                "sessions=", "ordered"])
+    except getopt.GetoptError as err:
+        print(str(err), file=sys.stderr)
+        usage(2)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+        elif o in ('-c', '--config'):
+            configfile = a
+        elif o in ('-f', '--file'):
+            infile = a
+        elif o in ('-l', '--location'):
+            location = a
+        elif o in ('-n', '--inflight'):
+            inflight = int(a)
+        elif o in ('-s', '--sessions'):
+            sessions = int(a)
+        elif o in ('-o', '--ordered'):
+            ordered = True
+
+    logging.config.fileConfig(configfile)
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    conf = config['client']
+
+    pool = ClientPool(client_factory(config), sessions, conf['username'],
+        conf['password'], conf['location_code'])
+
+    pipeline = CheckinPipeline(pool, location or conf['location_code'],
+        max_inflight = inflight or sessions, ordered = ordered)
+
+    def emit(result):
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+    source = open(infile) if infile else sys.stdin
+    try:
+        pipeline.run(source, emit)
+    finally:
+        pipeline.log_stats()
+        pool.close()
+
+if __name__ == '__main__':
+    main()
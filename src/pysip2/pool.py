@@ -0,0 +1,151 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+import logging, threading, contextlib, queue
+
+class PoolTimeoutError(Exception):
+    ''' No pooled client became available in time '''
+    pass
+
+class ClientPool(object):
+    ''' Thread-safe pool of logged-in Clients for one ACS endpoint.
+
+    Clients are created, connected and logged in on first use.  A client
+    that raises an I/O error is discarded and replaced on a later
+    acquire().
+
+        pool = ClientPool(lambda: Client(host, port), 4,
+            username, password, location_code)
+        resp = pool.call('item_info_request', barcode)
+    '''
+
+    def __init__(self, make_client, size, username, password,
+            location_code, **kwargs):
+        '''
+        make_client : function returning a new, unconnected Client
+
+        kwargs:
+            guard : pysip2.limits.Guard applied to every call()
+            acquire_timeout : seconds acquire() waits for a free
+                client.  None waits forever.
+            rate_limiter : pysip2.limits.RateLimiter applied to every
+                pooled client.
+            priority : 'interactive' (default) or 'batch'; the rate
+                limit priority of this pool's clients.
+        '''
+        self.make_client = make_client
+        self.size = size
+        self.username = username
+        self.password = password
+        self.location_code = location_code
+        self.guard = kwargs.get('guard')
+        self.acquire_timeout = kwargs.get('acquire_timeout')
+        self.rate_limiter = kwargs.get('rate_limiter')
+        self.priority = kwargs.get('priority', 'interactive')
+
+        # None entries are slots without a live client
+        self.idle = queue.LifoQueue()
+        for i in range(size):
+            self.idle.put(None)
+
+        self.lock = threading.Lock()
+        self.clients = set()
+
+    def open_client(self):
+        client = self.make_client()
+        if self.rate_limiter is not None:
+            client.rate_limit(self.rate_limiter, self.priority)
+        client.connect()
+        if not client.login(self.username, self.password, self.location_code):
+            client.disconnect()
+            raise IOError('SIP login failed for %s' % self.username)
+        with self.lock:
+            self.clients.add(client)
+        return client
+
+    def acquire(self, timeout=None):
+        ''' Returns a connected, logged-in Client.  Must be handed back
+        with release().
+        '''
+        if timeout is None:
+            timeout = self.acquire_timeout
+
+        try:
+            client = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise PoolTimeoutError('No SIP client available')
+
+        if client is not None:
+            return client
+
+        try:
+            return self.open_client()
+        except:
+            self.idle.put(None)
+            raise
+
+    def release(self, client, broken=False):
+        ''' Returns a client to the pool.  Broken clients are closed and
+        their slot is refilled on demand.
+        '''
+        if broken:
+            self.discard(client)
+            self.idle.put(None)
+        else:
+            self.idle.put(client)
+
+    def discard(self, client):
+        with self.lock:
+            self.clients.discard(client)
+        try:
+            client.disconnect()
+        except:
+            pass
+
+    @contextlib.contextmanager
+    def client(self, timeout=None):
+        ''' Context manager form of acquire() / release() '''
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except (IOError, OSError):
+            self.release(client, broken=True)
+            raise
+        except:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def call(self, method, *args, **kwargs):
+        ''' Runs a Client method on a pooled client, e.g.
+        pool.call('checkin_request', barcode, location)
+        '''
+        with self.client() as client:
+            return self.run(client, method, *args, **kwargs)
+
+    def run(self, client, method, *args, **kwargs):
+        ''' Runs a Client method on an acquired client, applying the
+        pool's guard if there is one.
+        '''
+        if self.guard is not None:
+            return self.guard.call(client, method, *args, **kwargs)
+        return getattr(client, method)(*args, **kwargs)
+
+    def close(self):
+        ''' Disconnects all pooled clients '''
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            self.discard(client)
@@ -0,0 +1,360 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Connection-concentrating SIP2 proxy.
+
+Many downstream SC connections log in to the proxy, and their requests
+are multiplexed over a small pool of logged-in upstream Client sessions.
+
+    PYTHONPATH=src python3 src/pysip2/proxy.py -c pysip2-client.ini
+
+Upstream connection settings come from the [client] and [ssl] sections
+of the configuration file; proxy settings from the [proxy] section.
+'''
+import sys, time, logging, asyncio, concurrent.futures
+import logging.config, getopt, configparser
+from gettext import gettext as _
+from pysip2.spec import MessageSpec as mspec
+from pysip2.spec import TEXT_ENCODING, LINE_TERMINATOR
+from pysip2.message import Message
+from pysip2.server import Server, checksum, split_sequence, join_sequence
+from pysip2.config import client_factory
+
+class Upstream(object):
+    ''' One logged-in upstream Client session and its statistics '''
+
+    def __init__(self, index, make_client, username, password, location_code):
+        self.index = index
+        self.make_client = make_client
+        self.username = username
+        self.password = password
+        self.location_code = location_code
+        self.client = None
+        self.seq = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def __str__(self):
+        return 'upstream-%d' % self.index
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) % 10
+        return str(self.seq)
+
+    def ensure_connected(self):
+        if self.client is not None:
+            return
+
+        client = self.make_client()
+        client.connect()
+        if not client.login(self.username, self.password, self.location_code):
+            client.disconnect()
+            raise IOError('Upstream login failed for %s' % self.username)
+
+        logging.info(_('{0} connected and logged in').format(self))
+        self.client = client
+
+    def forward(self, spec, txt):
+        ''' Sends message text upstream and returns the reply Message,
+        or None for messages that have no reply.  Runs in a worker
+        thread; blocking I/O is fine here.
+        '''
+        start_time = time.time()
+        try:
+            self.ensure_connected()
+            client = self.client
+            frame = (txt + LINE_TERMINATOR).encode(TEXT_ENCODING)
+
+            if spec is mspec.block_patron:
+                client.send_bytes([frame])
+                return None
+
+            client.client_log.start_msg(spec)
+            client.send_bytes([frame])
+            reply = client.recv_msg()
+
+            # timing is kept here; don't let the client log grow forever
+            client.client_log.messages.clear()
+            return reply
+
+        except (IOError, OSError):
+            self.errors = self.errors + 1
+            if self.client is not None:
+                try:
+                    self.client.disconnect()
+                except:
+                    pass
+            self.client = None
+            raise
+
+        finally:
+            self.requests = self.requests + 1
+            self.total_time = self.total_time + time.time() - start_time
+
+
+class Proxy(Server):
+    ''' SIP2 proxy.  Downstream SCs log in to the proxy itself; every
+    other request is forwarded over a pool of upstream sessions.
+    '''
+
+    def __init__(self, host, port, make_client, upstream_login, **kwargs):
+        '''
+        make_client : function returning a new, unconnected Client
+        upstream_login : (username, password, location_code) used
+            for every upstream session.
+
+        kwargs (in addition to the Server kwargs):
+            upstream_sessions : size of the upstream pool.  Default 4.
+            rewrite : {field code: value} map applied to forwarded
+                requests that contain the field, e.g. {'AO': 'main'}
+            sc_status_ttl : seconds to answer 99 SC Status locally
+                from the last upstream 98 reply.  0 disables.
+        '''
+        super(Proxy, self).__init__(host, port, **kwargs)
+
+        self.rewrite = kwargs.get('rewrite', {})
+        self.sc_status_ttl = kwargs.get('sc_status_ttl', 0)
+        size = kwargs.get('upstream_sessions', 4)
+
+        self.upstreams = [
+            Upstream(i, make_client, *upstream_login) for i in range(size)]
+
+        self.idle = None # asyncio.Queue, created once the loop is running
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix='sip-upstream')
+        self.waiting = 0
+        self.max_waiting = 0
+
+        # last upstream 98 reply text, without sequence or checksum
+        self.sc_status_cache = None
+        self.sc_status_time = 0
+
+        # per-terminal stats: terminal => [requests, total seconds]
+        # Terminals are told apart by address and location, since SCs
+        # commonly share one proxy login.
+        self.terminals = {}
+
+        for code, spec in mspec.registry.items():
+            # 97 ACS Resend is answered by the Server from the
+            # session's own last reply; upstream sessions are shared
+            if spec not in (mspec.login, mspec.acs_resend):
+                self.add_handler(spec, self.forward)
+        self.default_handler = self.forward
+
+    async def start(self):
+        self.idle = asyncio.Queue()
+        for upstream in self.upstreams:
+            self.idle.put_nowait(upstream)
+        await super(Proxy, self).start()
+
+    def rewrite_body(self, body):
+        ''' Applies configured field rewrites to message text '''
+        msg = Message(msg_txt = body + LINE_TERMINATOR)
+        changed = False
+        for code, value in self.rewrite.items():
+            if msg.set_field_value(code, value):
+                changed = True
+        if changed:
+            return str(msg)
+        return body
+
+    @staticmethod
+    def terminal_name(session):
+        peer = session.peer
+        if isinstance(peer, tuple):
+            peer = '%s:%s' % peer[:2]
+        if session.location_code:
+            return '%s/%s' % (peer, session.location_code)
+        return str(peer)
+
+    def record_terminal(self, session, start_time):
+        stats = self.terminals.setdefault(
+            self.terminal_name(session), [0, 0.0])
+        stats[0] = stats[0] + 1
+        stats[1] = stats[1] + time.time() - start_time
+
+    async def forward(self, session, msg):
+        spec = msg.spec
+        start_time = time.time()
+        body, seq, has_checksum = split_sequence(
+            msg.msg_txt.rstrip(LINE_TERMINATOR))
+
+        if spec is mspec.sc_status and self.sc_status_ttl and \
+                self.sc_status_cache is not None and \
+                time.time() - self.sc_status_time < self.sc_status_ttl:
+            # the server adds the caller's own sequence number
+            self.record_terminal(session, start_time)
+            return Message(msg_txt = self.sc_status_cache + LINE_TERMINATOR)
+
+        if self.rewrite and spec.known:
+            body = self.rewrite_body(body)
+
+        self.waiting = self.waiting + 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        upstream = await self.idle.get()
+        self.waiting = self.waiting - 1
+
+        try:
+            txt = join_sequence(
+                body, None if seq is None else upstream.next_seq(),
+                has_checksum)
+            reply = await asyncio.get_running_loop().run_in_executor(
+                self.executor, upstream.forward, spec, txt)
+        except (IOError, OSError) as e:
+            logging.warn('%s failed forwarding %s: %s' % (
+                upstream, spec.code, e))
+            # no reply is coming; close the session rather than leave
+            # the SC waiting for one
+            raise ConnectionAbortedError(
+                'upstream failure for %s' % session) from e
+        finally:
+            self.idle.put_nowait(upstream)
+
+        if reply is None:
+            self.record_terminal(session, start_time)
+            return None
+
+        # the server replaces the upstream sequence number with the
+        # terminal's own
+        if spec is mspec.sc_status:
+            self.sc_status_cache = split_sequence(
+                reply.msg_txt.rstrip(LINE_TERMINATOR))[0]
+            self.sc_status_time = time.time()
+
+        self.record_terminal(session, start_time)
+        return reply
+
+    def stats(self):
+        ''' Returns a dict of current proxy statistics '''
+
+        def avg(total, count):
+            return total / count if count else 0.0
+
+        return {
+            'connections': len(self.sessions),
+            'queue_depth': self.waiting,
+            'max_queue_depth': self.max_waiting,
+            'upstreams': dict([(str(u), {
+                'requests': u.requests,
+                'errors': u.errors,
+                'avg_latency': avg(u.total_time, u.requests),
+                'connected': u.client is not None
+            }) for u in self.upstreams]),
+            'terminals': dict([(t, {
+                'requests': s[0],
+                'avg_latency': avg(s[1], s[0])
+            }) for t, s in self.terminals.items()])
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(_('connections={0} queue_depth={1} max_queue_depth={2}')
+            .format(stats['connections'], stats['queue_depth'],
+                stats['max_queue_depth']))
+        for name, s in stats['upstreams'].items():
+            logging.info(_('{0} requests={1} errors={2} avg={3:.3f}').format(
+                name, s['requests'], s['errors'], s['avg_latency']))
+        for name, s in stats['terminals'].items():
+            logging.info(_('terminal {0} requests={1} avg={2:.3f}').format(
+                name, s['requests'], s['avg_latency']))
+
+    async def log_stats_forever(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.log_stats()
+
+
+def usage(exit_code=0):
+    print(_('''
+
+    -h, --help
+        Display this help message
+
+    -c <file>, --config <file>
+        Override the default configuration file.  The default file is
+        'pysip2-client.ini' in the current working directory.
+    '''))
+    sys.exit(exit_code)
+
+def main():
+    configfile = 'pysip2-client.ini'
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:", ["help", "config="])
+    except getopt.GetoptError as err:
+        print(str(err), file=sys.stderr)
+        usage(2)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+        elif o in ('-c', '--config'):
+            configfile = a
+
+    logging.config.fileConfig(configfile)
+    config = configparser.ConfigParser()
+    config.read(configfile)
+
+    client_conf = config['client']
+    proxy_conf = config['proxy'] if 'proxy' in config else {}
+
+    # upstream sessions are spread round-robin over the endpoint list
+    make_client = client_factory(config)
+
+    listen_host = proxy_conf.get('listen_host', '127.0.0.1')
+
+    # downstream credentials; when unset any login is accepted, which
+    # is only allowed on the loopback interface
+    username = proxy_conf.get('username')
+    password = proxy_conf.get('password')
+    if username is None and \
+            listen_host not in ('127.0.0.1', '::1', 'localhost'):
+        print(_('[proxy] username and password are required when '
+            'listening on {0}').format(listen_host), file=sys.stderr)
+        sys.exit(1)
+
+    async def authenticate(session, uid, pwd, location_code):
+        return username is None or (uid == username and pwd == password)
+
+    rewrite = {}
+    if proxy_conf.get('institution'):
+        rewrite['AO'] = proxy_conf.get('institution')
+
+    proxy = Proxy(
+        listen_host,
+        int(proxy_conf.get('listen_port', 6001)),
+        make_client,
+        (client_conf['username'], client_conf['password'],
+            client_conf['location_code']),
+        authenticate = authenticate,
+        upstream_sessions = int(proxy_conf.get('upstream_sessions', 4)),
+        sc_status_ttl = int(proxy_conf.get('sc_status_ttl', 0)),
+        max_connections = int(proxy_conf.get('max_connections', 10000)),
+        rewrite = rewrite
+    )
+
+    stats_interval = int(proxy_conf.get('stats_interval', 60))
+
+    async def run():
+        await proxy.start()
+        if stats_interval:
+            asyncio.ensure_future(proxy.log_stats_forever(stats_interval))
+        await proxy.serve_forever()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
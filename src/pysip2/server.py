@@ -0,0 +1,333 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+asyncio SIP2 ACS server.
+
+Requests are framed, parsed into Message objects and dispatched by
+message code to registered async handlers, which return the reply
+Message (or None for no reply).
+
+    server = Server('0.0.0.0', 6001, authenticate=check_login)
+
+    @server.handler(MessageSpec.item_info)
+    async def item_info(session, msg):
+        return Message(spec=MessageSpec.item_info_resp, ...)
+
+    asyncio.run(server.serve_forever())
+'''
+import re, asyncio, logging
+from gettext import gettext as _
+from pysip2.spec import MessageSpec as mspec
+from pysip2.spec import FieldSpec as fspec
+from pysip2.spec import FixedFieldSpec as ffspec
+from pysip2.spec import TEXT_ENCODING, LINE_TERMINATOR
+from pysip2.message import Message, FixedField, Field
+
+# trailing sequence number and optional checksum
+SEQUENCE_RE = re.compile(r'AY(\d)(AZ[0-9A-Fa-f]{4})?$')
+
+def checksum(txt):
+    ''' SIP2 checksum for message text ending in "AZ" '''
+    total = sum(txt.encode(TEXT_ENCODING)) & 0xFFFF
+    return '%04X' % ((-total) & 0xFFFF)
+
+def split_sequence(txt):
+    ''' Returns (body, sequence number, has checksum) for message text
+    without a line terminator.  sequence is None when absent.
+    '''
+    match = SEQUENCE_RE.search(txt)
+    if match is None:
+        return txt, None, False
+    return txt[:match.start()], match.group(1), match.group(2) is not None
+
+def join_sequence(body, seq, has_checksum):
+    ''' Inverse of split_sequence(), recomputing the checksum '''
+    if seq is None:
+        return body
+    txt = body + 'AY' + seq
+    if has_checksum:
+        txt = txt + 'AZ'
+        txt = txt + checksum(txt)
+    return txt
+
+
+class Session(object):
+    ''' State for a single SC connection '''
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.logged_in = False
+        self.username = None
+        self.location_code = None
+        self.requests = 0
+
+        # last reply frame sent on this connection, for 97 ACS Resend
+        self.last_reply = None
+
+        # free-form storage for handlers
+        self.data = {}
+
+    def __str__(self):
+        return 'Session(%s user=%s)' % (self.peer, self.username)
+
+
+class Server(object):
+    ''' SIP2 ACS server '''
+
+    LINE_TERMINATOR_BYTES = LINE_TERMINATOR.encode(TEXT_ENCODING)
+
+    def __init__(self, host='127.0.0.1', port=6001, **kwargs):
+        '''
+        kwargs:
+            authenticate : async function(session, username, password,
+                location_code) returning True on success.  Required to
+                accept 93 Login requests unless a 93 handler is added.
+            require_login : only 93 and 99 requests are accepted until
+                the session logs in.  Defaults to on.
+            max_connections : connections beyond this are closed
+                immediately.  Defaults to 10000.
+            max_frame_size : longest accepted request in bytes.
+                Defaults to 64k.
+            idle_timeout : seconds a connection may sit without sending
+                a request before it is closed.  None disables.
+            ssl : ssl.SSLContext for TLS connections
+            institution : institution id sent in generated 98 replies
+        '''
+        self.host = host
+        self.port = port
+        self.authenticate = kwargs.get('authenticate')
+        self.require_login = kwargs.get('require_login', True)
+        self.max_connections = kwargs.get('max_connections', 10000)
+        self.max_frame_size = kwargs.get('max_frame_size', 65536)
+        self.idle_timeout = kwargs.get('idle_timeout')
+        self.ssl = kwargs.get('ssl')
+        self.institution = kwargs.get('institution', '')
+
+        self.handlers = {} # message code => async handler
+
+        # handler for messages with no registered handler, if any
+        self.default_handler = None
+        self.sessions = set()
+        self.server = None
+
+        self.add_handler(mspec.login, self.handle_login)
+        self.add_handler(mspec.sc_status, self.handle_sc_status)
+
+    def add_handler(self, spec, fn):
+        ''' Registers an async handler(session, msg) for a request
+        MessageSpec, replacing any existing handler.
+        '''
+        self.handlers[spec.code] = fn
+
+    def handler(self, spec):
+        ''' Decorator form of add_handler() '''
+        def register(fn):
+            self.add_handler(spec, fn)
+            return fn
+        return register
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            ssl=self.ssl, limit=self.max_frame_size)
+
+        for sock in self.server.sockets:
+            logging.info(_('SIP server listening on {0}').format(
+                sock.getsockname()))
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for session in list(self.sessions):
+            session.writer.close()
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        session = Session(self, reader, writer)
+
+        if len(self.sessions) >= self.max_connections:
+            logging.warn('connection limit reached; dropping %s' % (
+                session.peer,))
+            writer.close()
+            return
+
+        self.sessions.add(session)
+        logging.debug('new connection from %s' % (session.peer,))
+
+        try:
+            await self.process_requests(session)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.exception('error processing %s: %s' % (session, e))
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+            logging.debug('connection closed for %s' % (session.peer,))
+
+    async def read_frame(self, session):
+        ''' Returns the next request frame as text, or None at EOF '''
+        reader = session.reader
+        try:
+            if self.idle_timeout:
+                frame = await asyncio.wait_for(
+                    reader.readuntil(Server.LINE_TERMINATOR_BYTES),
+                    self.idle_timeout)
+            else:
+                frame = await reader.readuntil(Server.LINE_TERMINATOR_BYTES)
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            logging.warn('oversized request from %s' % session)
+            return None
+        except asyncio.TimeoutError:
+            logging.debug('idle timeout for %s' % session)
+            return None
+
+        return frame.decode(TEXT_ENCODING)
+
+    async def process_requests(self, session):
+        ''' Handles requests on a connection one at a time.
+
+        Replies are flushed with drain() before the next request is
+        read, so an SC that stops reading stalls only its own session.
+        Each reply carries the request's sequence number, and a
+        checksum if the request had one.  A request no handler
+        accepts closes the session, since the SC would otherwise wait
+        for a reply until it times out.
+        '''
+
+        while True:
+            msg_txt = await self.read_frame(session)
+            if msg_txt is None:
+                return
+
+            session.requests = session.requests + 1
+            msg = Message(msg_txt = msg_txt)
+            code = msg.spec.code
+            seq, has_checksum = split_sequence(
+                msg_txt.rstrip(LINE_TERMINATOR))[1:]
+
+            if self.require_login and not session.logged_in and \
+                    code not in (mspec.login.code, mspec.sc_status.code):
+                logging.warn('%s sent %s before login; closing' % (
+                    session, code))
+                return
+
+            if code == mspec.acs_resend.code:
+                # Answered from this connection's own last reply.  It
+                # never reaches a handler, whose upstream state may be
+                # shared with other connections.
+                if session.last_reply is not None:
+                    session.writer.write(session.last_reply)
+                    await session.writer.drain()
+                continue
+
+            handler = self.handlers.get(code, self.default_handler)
+            if handler is None:
+                logging.warn('no handler for message %s from %s; closing'
+                    % (code, session))
+                return
+
+            reply = await handler(session, msg)
+            if reply is None:
+                continue
+
+            session.last_reply = self.reply_frame(reply, seq, has_checksum)
+            session.writer.write(session.last_reply)
+            await session.writer.drain()
+
+    @staticmethod
+    def reply_frame(reply, seq, has_checksum):
+        ''' Encoded reply frame, carrying the request's sequence number
+        in place of any the reply already has.
+        '''
+        if seq is None:
+            return reply.to_bytes()
+        txt = reply.to_bytes().decode(TEXT_ENCODING).rstrip(LINE_TERMINATOR)
+        body = split_sequence(txt)[0]
+        return (join_sequence(body, seq, has_checksum)
+            + LINE_TERMINATOR).encode(TEXT_ENCODING)
+
+    async def handle_login(self, session, msg):
+        ''' Default 93 handler; delegates to the authenticate callback '''
+
+        ok = False
+        if self.authenticate is not None:
+            ok = await self.authenticate(session,
+                msg.get_field_value(fspec.login_uid.code),
+                msg.get_field_value(fspec.login_pwd.code),
+                msg.get_field_value(fspec.location_code.code))
+
+        if ok:
+            session.logged_in = True
+            session.username = msg.get_field_value(fspec.login_uid.code)
+            session.location_code = \
+                msg.get_field_value(fspec.location_code.code)
+
+        return Message(
+            spec = mspec.login_resp,
+            fixed_fields = [FixedField(ffspec.ok, '1' if ok else '0')]
+        )
+
+    def supported_messages(self):
+        ''' BX supported messages value, as defined in the SIP2 spec '''
+        # flag order is fixed by the spec: patron status, checkout,
+        # checkin, block patron, SC status, resend, login, patron info,
+        # end session, fee paid, item info, item status update, patron
+        # enable, hold, renew, renew all
+        codes = ['23', '11', '09', '01', '99', '97', '93', '63', '35',
+            '37', '17', '19', '25', '15', '29', '65']
+        return ''.join(['Y' if c in self.handlers or
+            c == mspec.acs_resend.code else 'N' for c in codes])
+
+    async def handle_sc_status(self, session, msg):
+        ''' Default 99 handler.  Reports the server as online, with
+        capabilities derived from the registered handlers.
+        '''
+
+        def yn(spec):
+            return 'Y' if spec.code in self.handlers else 'N'
+
+        return Message(
+            spec = mspec.asc_status,
+            fixed_fields = [
+                FixedField(ffspec.online_status, 'Y'),
+                FixedField(ffspec.checkin_ok, yn(mspec.checkin)),
+                FixedField(ffspec.checkout_ok, yn(mspec.checkout)),
+                FixedField(ffspec.acs_renewal_policy, yn(mspec.renew)),
+                FixedField(ffspec.status_update_ok,
+                    yn(mspec.item_status_update)),
+                FixedField(ffspec.offline_ok, 'N'),
+                FixedField(ffspec.timeout_period, '000'),
+                FixedField(ffspec.retries_allowed, '000'),
+                FixedField(ffspec.date_time_sync, Message.sipdate()),
+                FixedField(ffspec.protocol_version, '2.00')
+            ],
+            fields = [
+                Field(fspec.institution_id, self.institution),
+                Field(fspec.supported_messages, self.supported_messages())
+            ]
+        )
@@ -19,6 +19,9 @@ import sys, logging, code, readline, shlex, time, os.path
 from gettext import gettext as _
 import logging.config, getopt, configparser
 import pysip2.client
+from pysip2.balance import parse_endpoints
+from pysip2.config import socket_args
+from pysip2.trace import Tracer
 
 # -----------------------------------------------------------------
 # Constants
@@ -125,6 +128,33 @@ class CommandRunner(object):
             [{'required' : True, 'label' : _('item-barcode')}]
         )
 
+        self.add_command('renew', self.renew,
+            _('Send a Renew (29) message.'),
+            [
+                {'required' : True, 'label' : _('item-barcode')},
+                {'required' : True, 'label' : _('patron-barcode')}
+            ]
+        )
+
+        self.add_command('renew-all', self.renew_all,
+            _('Send a Renew All (65) message.'),
+            [{'required' : True, 'label' : _('patron-barcode')}]
+        )
+
+        self.add_command('hold', self.hold,
+            _('Send a Hold (15) message.  Mode is +, - or *.'),
+            [
+                {'required' : True, 'label' : _('mode')},
+                {'required' : True, 'label' : _('item-barcode')},
+                {'required' : True, 'label' : _('patron-barcode')}
+            ]
+        )
+
+        self.add_command('end-session', self.end_session,
+            _('Send an End Patron Session (35) message.'),
+            [{'required' : True, 'label' : _('patron-barcode')}]
+        )
+
         self.add_command('server', self.set_sip_attr,
             _('View or set the current SIP server.'),
             [{'required' : False, 'label' : _('hostname')}]
@@ -199,19 +229,29 @@ class CommandRunner(object):
         conf = self.config
         self.disconnect(cmd, args)
 
-        self.client = pysip2.client.Client(conf.server, int(conf.port))
-        self.client.default_institution = conf.institution
-        #client.ssl_args(...) 
-        try:
-            self.client.connect()
-        except:
-            print(_('Unable to connect to server {0} port {1}').format(
-                conf.server, conf.port))
-            self.client = None
-            return False
+        # with several endpoints configured, use the first that answers
+        endpoints = conf.endpoints or [(conf.server, conf.port)]
+
+        for server, port in endpoints:
+            self.client = pysip2.client.Client(
+                server, None if port is None else int(port))
+            self.client.default_institution = conf.institution
+            self.client.socket_args(**conf.socket_args)
+            #client.ssl_args(...) 
+            if conf.tracer is not None:
+                self.client.trace(conf.tracer)
+            try:
+                self.client.connect()
+            except:
+                print(_('Unable to connect to server {0} port {1}').format(
+                    server, port))
+                self.client = None
+                continue
+
+            print (_('Connect OK'))
+            return True
 
-        print (_('Connect OK'))
-        return True
+        return False
 
     def disconnect(self, cmd, *args):
 
@@ -270,6 +310,26 @@ class CommandRunner(object):
         print(repr(resp))
         return True
 
+    def renew(self, cmd, *args):
+        resp = self.client.renew_request(args[0], args[1])
+        print(repr(resp))
+        return True
+
+    def renew_all(self, cmd, *args):
+        resp = self.client.renew_all_request(args[0])
+        print(repr(resp))
+        return True
+
+    def hold(self, cmd, *args):
+        resp = self.client.hold_request(args[2], args[0], item_id=args[1])
+        print(repr(resp))
+        return True
+
+    def end_session(self, cmd, *args):
+        resp = self.client.end_patron_session(args[0])
+        print(repr(resp))
+        return True
+
     def set_sip_attr(self, attr, *args):
 
         if len(args) == 0:
@@ -286,6 +346,10 @@ class CommandRunner(object):
         setattr(self.config, attr, args[0])
         print(_('Set SIP attribute "{0}" to "{1}"').format(attr, args[0]))
 
+        if attr in ('server', 'port'):
+            # an explicit server replaces any configured endpoint list
+            self.config.endpoints = []
+
         return True
 
     def set_conf_attr(self, attr, *args):
@@ -322,7 +386,9 @@ class CommandRunner(object):
 
         # These commands require an active SIP connection
         if command in ['status','patron-status','patron-info',
-            'item-info','checkout','checkin'] and not self.client:
+            'item-info','checkout','checkin','renew','renew-all',
+            'hold','end-session'] \
+            and not self.client:
             print(_('Command cannot be executed without a SIP server '
                 'connection.  Try running the "start" command.'))
             return
@@ -354,6 +420,9 @@ class ConfigHandler(object):
         self.location_code = None
         self.autostart = False
         self.timing = 'off'
+        self.socket_args = {}
+        self.endpoints = []
+        self.tracer = None
 
     def setup(self):
 
@@ -378,6 +447,17 @@ class ConfigHandler(object):
         self.password = config['client'].get('password', None)
         self.location_code = config['client'].get('location_code', None)
 
+        if config['client'].get('endpoints'):
+            self.endpoints = parse_endpoints(
+                config['client']['endpoints'], self.port)
+
+        client_conf = config['client']
+        self.socket_args = socket_args(client_conf)
+
+        if client_conf.get('trace_file'):
+            self.tracer = Tracer(client_conf['trace_file'],
+                sample_rate = client_conf.getfloat('trace_sample_rate', 1.0))
+
     def read_ops(self):
 
         try:
@@ -12,8 +12,13 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 # -----------------------------------------------------------------------
-import logging
-from gettext import gettext as _
+import logging, gettext
+
+def _(label):
+    '''Marks a spec label for translation.  Labels are translated when
+    first displayed, not at import.
+    '''
+    return label
 
 # -----------------------------------------------------------------
 # Constants
@@ -29,23 +34,42 @@ STRING_COLUMN_PAD   = 32 # for printing messages in columnar displays
 # Classes for modeling and tracking message and field specifications
 # -----------------------------------------------------------------
 
-class FixedFieldSpec(object):
+class LabeledSpec(object):
+    '''Base for specs whose label is translated on first use'''
+
+    @property
+    def label(self):
+        if self.translated_label is None:
+            self.translated_label = gettext.gettext(self.raw_label)
+        return self.translated_label
+
+    @label.setter
+    def label(self, value):
+        self.raw_label = value
+        self.translated_label = None
+
+class FixedFieldSpec(LabeledSpec):
     def __init__(self, length, label):
         self.length = length
         self.label = label
+        self.name = None # attribute name, set once all specs are defined
 
     def __str__(self):
         return 'FixedFieldSpec() length=%s label=%s' % (
             self.length, self.label)
 
-class FieldSpec(object):
+class FieldSpec(LabeledSpec):
 
     registry = {} # code => spec map of registered fields
 
-    def __init__(self, code, label):
+    def __init__(self, code, label, **kwargs):
         self.code = code
         self.label = label
-        FieldSpec.registry[code] = self
+        # as with MessageSpec, specs for unknown codes are not
+        # registered, so a misbehaving server cannot grow the registry
+        self.known = kwargs.get('register', True)
+        if self.known:
+            FieldSpec.registry[code] = self
 
     def __str__(self):
         return 'FieldSpec() code=%s label=%s' % (self.code, self.label)
@@ -57,10 +81,10 @@ class FieldSpec(object):
             # no spec found for the given code.  This can happen when
             # nonstandard fields are used (which is OK).  Create a new 
             # spec using the code as the label.
-            return FieldSpec(code, code)
+            return FieldSpec(code, code, register=False)
         return spec
 
-class MessageSpec(object):
+class MessageSpec(LabeledSpec):
 
     # code => spec map of registered message specs
     registry = {}
@@ -69,8 +93,38 @@ class MessageSpec(object):
     def __init__(self, code, label, **kwargs):
         self.code     = code
         self.label    = label
+        self.name     = None # attribute name, set once all specs are defined
         self.fixed_fields  = kwargs.get('fixed_fields', [])
-        MessageSpec.registry[code] = self
+
+        # Specs for unknown message codes are not registered, so a
+        # misbehaving server cannot grow the registry.
+        self.known = kwargs.get('register', True)
+        if self.known:
+            MessageSpec.registry[code] = self
+
+    def fixed_field_index(self, name):
+        '''Returns the position of the named fixed field within this
+        message's fixed fields, or None if the message has no such field.
+        '''
+        index = getattr(self, '_ff_index', None)
+        if index is None:
+            index = {}
+            for pos, ffspec in enumerate(self.fixed_fields):
+                index[ffspec.name] = pos
+            self._ff_index = index
+        return index.get(name)
+
+    def fixed_field_offsets(self):
+        '''Returns a list of (FixedFieldSpec, offset) pairs, where offset
+        is the position of the field's first character in the raw
+        message text, i.e. after the 2-character message code.
+        '''
+        offsets = []
+        offset = 2
+        for ffspec in self.fixed_fields:
+            offsets.append((ffspec, offset))
+            offset = offset + ffspec.length
+        return offsets
 
     @staticmethod
     def find_by_code(code):
@@ -80,6 +134,14 @@ class MessageSpec(object):
             logging.warn("No message spec found with code '%s'" % code)
         return spec
 
+    @staticmethod
+    def unknown(code):
+        '''Returns an unregistered spec for a message code with no known
+        spec.  It has no fixed fields, so messages using it are kept as
+        raw text.
+        '''
+        return MessageSpec(code, code, register=False)
+
 # -----------------------------------------------------------------
 # Fixed Fields
 # -----------------------------------------------------------------
@@ -124,6 +186,14 @@ FixedFieldSpec.offline_ok         = FixedFieldSpec(1, _('offline ok'))
 FixedFieldSpec.timeout_period     = FixedFieldSpec(3, _('timeout period'))
 FixedFieldSpec.retries_allowed    = FixedFieldSpec(3, _('retries allowed'))
 FixedFieldSpec.date_time_sync     = FixedFieldSpec(18,_('date/time sync'))
+FixedFieldSpec.third_party_allowed= FixedFieldSpec(1, _('third party allowed'))
+FixedFieldSpec.renewed_count      = FixedFieldSpec(4, _('renewed count'))
+FixedFieldSpec.unrenewed_count    = FixedFieldSpec(4, _('unrenewed count'))
+FixedFieldSpec.card_retained      = FixedFieldSpec(1, _('card retained'))
+FixedFieldSpec.hold_mode          = FixedFieldSpec(1, _('hold mode'))
+FixedFieldSpec.available          = FixedFieldSpec(1, _('available'))
+FixedFieldSpec.item_properties_ok = FixedFieldSpec(1, _('item properties ok'))
+FixedFieldSpec.end_session        = FixedFieldSpec(1, _('end session'))
 
 # -----------------------------------------------------------------
 # Variable-Length Fields
@@ -365,3 +435,128 @@ MessageSpec.fee_paid_resp = MessageSpec(
         FixedFieldSpec.date
     ]
 )
+
+MessageSpec.renew = MessageSpec(
+    '29', _('Renew'),
+    fixed_fields = [
+        FixedFieldSpec.third_party_allowed,
+        FixedFieldSpec.no_block,
+        FixedFieldSpec.date,
+        FixedFieldSpec.nb_due_date
+    ]
+)
+
+MessageSpec.renew_resp = MessageSpec(
+    '30', _('Renew Response'),
+    fixed_fields = [
+        FixedFieldSpec.ok,
+        FixedFieldSpec.renewal_ok,
+        FixedFieldSpec.magnetic_media,
+        FixedFieldSpec.desensitize,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.renew_all = MessageSpec(
+    '65', _('Renew All'),
+    fixed_fields = [
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.renew_all_resp = MessageSpec(
+    '66', _('Renew All Response'),
+    fixed_fields = [
+        FixedFieldSpec.ok,
+        FixedFieldSpec.renewed_count,
+        FixedFieldSpec.unrenewed_count,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.block_patron = MessageSpec(
+    '01', _('Block Patron'),
+    fixed_fields = [
+        FixedFieldSpec.card_retained,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.hold = MessageSpec(
+    '15', _('Hold'),
+    fixed_fields = [
+        FixedFieldSpec.hold_mode,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.hold_resp = MessageSpec(
+    '16', _('Hold Response'),
+    fixed_fields = [
+        FixedFieldSpec.ok,
+        FixedFieldSpec.available,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.item_status_update = MessageSpec(
+    '19', _('Item Status Update'),
+    fixed_fields = [
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.item_status_update_resp = MessageSpec(
+    '20', _('Item Status Update Response'),
+    fixed_fields = [
+        FixedFieldSpec.item_properties_ok,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.patron_enable = MessageSpec(
+    '25', _('Patron Enable'),
+    fixed_fields = [
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.patron_enable_resp = MessageSpec(
+    '26', _('Patron Enable Response'),
+    fixed_fields = [
+        FixedFieldSpec.patron_status,
+        FixedFieldSpec.language,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.end_patron_session = MessageSpec(
+    '35', _('End Patron Session'),
+    fixed_fields = [
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.end_session_resp = MessageSpec(
+    '36', _('End Session Response'),
+    fixed_fields = [
+        FixedFieldSpec.end_session,
+        FixedFieldSpec.date
+    ]
+)
+
+MessageSpec.sc_resend = MessageSpec('96', _('Request SC Resend'))
+
+MessageSpec.acs_resend = MessageSpec('97', _('Request ACS Resend'))
+
+# -----------------------------------------------------------------
+# Give each spec the name it's registered under
+# -----------------------------------------------------------------
+
+for name, value in list(vars(FixedFieldSpec).items()):
+    if isinstance(value, FixedFieldSpec):
+        value.name = name
+
+for name, value in list(vars(MessageSpec).items()):
+    if isinstance(value, MessageSpec):
+        value.name = name
@@ -0,0 +1,141 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Per-phase request tracing.
+
+A Tracer writes sampled client requests to a JSON-lines file in the
+OpenTelemetry file exporter layout: one OTLP/JSON export request per
+line, holding the spans of one trace.  A request span has one child
+span per phase:
+
+    send      : request handed to the kernel
+    wait      : time to first byte of the response
+    receive   : first byte to complete frame
+    parse     : frame to parsed Message
+
+Connects are traced as a connect span with tcp connect and, for TLS,
+tls handshake children.
+
+    client.trace(Tracer('/tmp/sip2-trace.jsonl', sample_rate=0.01))
+'''
+import json, random, threading
+
+def nanos(timestamp):
+    return int(timestamp * 1e9)
+
+class Tracer(object):
+    ''' Writes sampled spans to a JSON-lines trace file '''
+
+    def __init__(self, path=None, **kwargs):
+        '''
+        path : trace file, opened for append.
+
+        kwargs:
+            file : write to this open file object instead of path.
+            sample_rate : fraction of requests traced, 0.0 - 1.0.
+                Default 1.0.  Connects are always traced.
+            service_name : resource service.name.  Default 'pysip2'.
+        '''
+        self.file = kwargs.get('file')
+        if self.file is None:
+            self.file = open(path, 'a', buffering=1)
+        self.sample_rate = kwargs.get('sample_rate', 1.0)
+        self.service_name = kwargs.get('service_name', 'pysip2')
+        self.lock = threading.Lock()
+
+    def sample(self):
+        ''' True if the current request should be traced '''
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def span(self, name, trace_id, start, end, parent_id=None, attrs=None):
+        ''' Returns a span dict; start and end are time.time() values '''
+        span = {
+            'traceId': '%032x' % random.getrandbits(128) \
+                if trace_id is None else trace_id,
+            'spanId': '%016x' % random.getrandbits(64),
+            'name': name,
+            'kind': 3, # SPAN_KIND_CLIENT
+            'startTimeUnixNano': nanos(start),
+            'endTimeUnixNano': nanos(end),
+            'attributes': []
+        }
+        if parent_id is not None:
+            span['parentSpanId'] = parent_id
+        for key, value in (attrs or {}).items():
+            if isinstance(value, bool):
+                value = {'boolValue': value}
+            elif isinstance(value, int):
+                value = {'intValue': value}
+            else:
+                value = {'stringValue': str(value)}
+            span['attributes'].append({'key': key, 'value': value})
+        return span
+
+    def export(self, spans):
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name',
+                'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'pysip2'}, 'spans': spans}]
+        }]}) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def trace_connect(self, endpoint, start, end, handshake=None):
+        ''' Exports a connect span.  handshake is the transport's
+        (duration, resumed) tuple for TLS connections.
+        '''
+        root = self.span('sip2 connect', None, start, end,
+            attrs={'server.address': endpoint})
+        spans = [root]
+        tid = root['traceId']
+        pid = root['spanId']
+
+        if handshake is None:
+            spans.append(self.span('tcp connect', tid, start, end, pid))
+        else:
+            duration, resumed = handshake
+            spans.append(
+                self.span('tcp connect', tid, start, end - duration, pid))
+            spans.append(self.span('tls handshake', tid,
+                end - duration, end, pid, {'tls.resumed': bool(resumed)}))
+
+        self.export(spans)
+
+    def trace_message(self, endpoint, msg):
+        ''' Exports the phases of a completed ClientLog.ClientMessage '''
+        root = self.span('sip2 %s' % msg.spec.code, None,
+            msg.start_time, msg.end_time, attrs={
+                'server.address': endpoint,
+                'sip2.message.code': msg.spec.code,
+                'sip2.message.name': msg.spec.label
+            })
+        tid = root['traceId']
+        pid = root['spanId']
+        spans = [root]
+
+        phases = [
+            ('send', msg.start_time, msg.sent_time),
+            ('wait', msg.sent_time, msg.first_byte_time),
+            ('receive', msg.first_byte_time, msg.frame_time),
+            ('parse', msg.frame_time, msg.end_time)
+        ]
+        for name, start, end in phases:
+            if start and end:
+                spans.append(self.span(name, tid, start, end, pid))
+
+        self.export(spans)
+
+    def close(self):
+        self.file.close()
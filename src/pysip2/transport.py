@@ -0,0 +1,464 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+import socket, time, errno, logging, collections, threading
+
+class Transport(object):
+    ''' Moves bytes between a Client and a SIP2 server.
+
+    Subclasses implement connect(), send(), recv_into() and close().
+    '''
+
+    def __init__(self):
+        # (duration, resumed) of the most recent TLS handshake, if any
+        self.handshake = None
+
+    def connect(self):
+        raise NotImplementedError()
+
+    def send(self, bufs):
+        ''' Writes every byte of every buffer in the list bufs '''
+        raise NotImplementedError()
+
+    def recv_into(self, buf):
+        ''' Reads available bytes into the writable buffer buf.
+
+        Returns the number of bytes read.  0 means the server
+        closed the connection.
+        '''
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class SocketTransport(Transport):
+    ''' Base class for transports that wrap a stream socket '''
+
+    # Max number of buffers handed to a single sendmsg() call.  Most
+    # platforms cap the iovec count at 1024 (IOV_MAX).
+    IOV_MAX = 1024
+
+    def __init__(self):
+        super(SocketTransport, self).__init__()
+        self.sock = None
+
+    def send(self, bufs):
+        ''' Writes a list of pre-encoded frames to the socket.
+
+        Uses vectored sendmsg() calls, so a whole batch of frames goes
+        out in a single syscall without first being joined.  Short
+        writes are resumed from where they left off.
+        '''
+
+        if len(bufs) == 0:
+            return
+
+        sock = self.connected_sock()
+        if not hasattr(sock, 'sendmsg'):
+            self.sendall(bufs)
+            return
+
+        views = collections.deque(memoryview(b) for b in bufs)
+
+        while len(views) > 0:
+            if len(views) > SocketTransport.IOV_MAX:
+                sent = sock.sendmsg(list(views)[:SocketTransport.IOV_MAX])
+            else:
+                sent = sock.sendmsg(views)
+
+            # drop fully written buffers and trim a partially written one
+            while sent > 0:
+                head = views[0]
+                if sent >= len(head):
+                    sent = sent - len(head)
+                    views.popleft()
+                else:
+                    views[0] = head[sent:]
+                    sent = 0
+
+    def connected_sock(self):
+        ''' Returns the socket, or raises OSError if there is none '''
+        if self.sock is None:
+            raise OSError(errno.ENOTCONN, 'SIP2 transport is not connected')
+        return self.sock
+
+    def sendall(self, bufs):
+        if len(bufs) == 1:
+            self.connected_sock().sendall(bufs[0])
+        else:
+            self.connected_sock().sendall(b''.join(bufs))
+
+    def recv_into(self, buf):
+        return self.connected_sock().recv_into(buf)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class TcpTransport(SocketTransport):
+    ''' Plain TCP transport '''
+
+    # (server, port, family) => (expire_time, addrinfo list).  Shared
+    # by all transports so reconnects can skip the DNS lookup.
+    addr_cache = {}
+
+    ADDRESS_FAMILIES = {
+        'any'  : socket.AF_UNSPEC,
+        'ipv4' : socket.AF_INET,
+        'ipv6' : socket.AF_INET6
+    }
+
+    def __init__(self, server, port, **kwargs):
+        '''
+        kwargs:
+            tcp_nodelay : disable Nagle's algorithm.  SIP2 frames are
+                small request/response pairs, so this defaults to on.
+            keepalive : enable SO_KEEPALIVE
+            keepalive_idle : seconds of idle time before keepalive
+                probes are sent, where supported.
+            keepalive_interval : seconds between keepalive probes
+            keepalive_count : failed probes before the connection drops
+            recv_bufsize : SO_RCVBUF size in bytes.  Uses the OS
+                default when unset.
+            address_family : 'any' (IPv4 or IPv6), 'ipv4', or 'ipv6'
+            dns_cache_ttl : seconds to cache resolved server addresses.
+                0 disables the cache.
+            timeout : seconds to wait on connect, send or receive before
+                raising socket.timeout.  None (the default) waits forever.
+        '''
+        super(TcpTransport, self).__init__()
+        self.server = server
+        self.port = port
+        self.tcp_nodelay = kwargs.get('tcp_nodelay', True)
+        self.keepalive = kwargs.get('keepalive', False)
+        self.keepalive_idle = kwargs.get('keepalive_idle')
+        self.keepalive_interval = kwargs.get('keepalive_interval')
+        self.keepalive_count = kwargs.get('keepalive_count')
+        self.recv_bufsize = kwargs.get('recv_bufsize')
+        self.dns_cache_ttl = kwargs.get('dns_cache_ttl', 300)
+        self.timeout = kwargs.get('timeout')
+
+        family = kwargs.get('address_family', 'any')
+        if family not in TcpTransport.ADDRESS_FAMILIES:
+            raise ValueError('Invalid address family: %s' % family)
+        self.address_family = family
+
+    def __str__(self):
+        return '%s:%s' % (self.server, self.port)
+
+    def connect(self):
+        ''' Connects to the server.
+
+        Each address the server name resolves to is tried in turn
+        until one accepts the connection.
+        '''
+
+        error = None
+        self.sock = None
+
+        for family, socktype, proto, canonname, addr in self.resolve():
+            sock = socket.socket(family, socktype, proto)
+            try:
+                self.setup_socket(sock)
+                sock.connect(addr)
+                self.sock = sock
+                break
+            except OSError as e:
+                error = e
+                sock.close()
+
+        if self.sock is None:
+            # don't keep serving an address that no longer answers
+            TcpTransport.addr_cache.pop(self.addr_cache_key(), None)
+            raise error
+
+    def addr_cache_key(self):
+        return (self.server, self.port, self.address_family)
+
+    def resolve(self):
+        ''' Returns the getaddrinfo() list for the server, using the
+        shared address cache when possible.
+        '''
+        key = self.addr_cache_key()
+        now = time.time()
+
+        if self.dns_cache_ttl:
+            cached = TcpTransport.addr_cache.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        infos = socket.getaddrinfo(self.server, self.port,
+            TcpTransport.ADDRESS_FAMILIES[self.address_family],
+            socket.SOCK_STREAM)
+
+        if self.dns_cache_ttl:
+            TcpTransport.addr_cache[key] = (now + self.dns_cache_ttl, infos)
+
+        return infos
+
+    def setup_socket(self, sock):
+        ''' Applies configured socket options to a not-yet-connected
+        socket.
+        '''
+
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if self.recv_bufsize:
+            # must be set before connect to affect the TCP window
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_bufsize)
+
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+            # Linux uses TCP_KEEPIDLE, macOS uses TCP_KEEPALIVE.
+            idle_opt = getattr(socket, 'TCP_KEEPIDLE',
+                getattr(socket, 'TCP_KEEPALIVE', None))
+
+            for opt, value in [
+                    (idle_opt, self.keepalive_idle),
+                    (getattr(socket, 'TCP_KEEPINTVL', None),
+                        self.keepalive_interval),
+                    (getattr(socket, 'TCP_KEEPCNT', None),
+                        self.keepalive_count)]:
+                if value is None: continue
+                if opt is None:
+                    logging.debug('keepalive tuning not supported here')
+                    continue
+                sock.setsockopt(socket.IPPROTO_TCP, opt, int(value))
+
+
+class TlsTransport(TcpTransport):
+    ''' TCP transport wrapped in TLS '''
+
+    # (server, port, require_valid_cert, check_hostname) => SSLContext.
+    # Contexts are expensive to build (CA bundle load), so transports
+    # talking to the same server share one.
+    ssl_contexts = {}
+    ssl_contexts_lock = threading.Lock()
+
+    # (server, port, SSLContext) => most recent SSLSession, for TLS
+    # resumption.  A session can only be resumed with the context that
+    # created it.
+    ssl_sessions = {}
+
+    def __init__(self, server, port, **kwargs):
+        '''
+        Accepts the TcpTransport kwargs plus:
+            require_valid_cert : fail on untrusted certificate
+            check_hostname : fail if the certificate hostname does
+                not match SIP server hostname.
+            context : use this ssl.SSLContext instead of the shared
+                context for the server.
+            session_reuse : resume the previous TLS session on
+                reconnect.  Defaults to on.
+        '''
+        super(TlsTransport, self).__init__(server, port, **kwargs)
+        self.require_valid_cert = kwargs.get('require_valid_cert', True)
+        self.check_hostname = kwargs.get('check_hostname', True)
+        self.context = kwargs.get('context')
+        self.session_reuse = kwargs.get('session_reuse', True)
+
+    def get_context(self):
+        ''' Returns the SSLContext for this transport, creating and
+        caching a shared context for the server on first use.
+        '''
+
+        if self.context is not None:
+            return self.context
+
+        key = (self.server, self.port,
+            self.require_valid_cert, self.check_hostname)
+
+        with TlsTransport.ssl_contexts_lock:
+            context = TlsTransport.ssl_contexts.get(key)
+            if context is not None:
+                return context
+
+            # ssl is slow to import; plain TCP clients never need it
+            import ssl
+            context = ssl.create_default_context()
+
+            if self.require_valid_cert:
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.check_hostname = self.check_hostname
+            else:
+                logging.warn('SSL certificate checks disabled. ' +
+                    'This is probably not what you want!')
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+
+            TlsTransport.ssl_contexts[key] = context
+            return context
+
+    def connect(self):
+        import ssl
+        super(TlsTransport, self).connect()
+
+        context = self.get_context()
+        session_key = (self.server, self.port, context)
+
+        session = None
+        if self.session_reuse:
+            session = TlsTransport.ssl_sessions.get(session_key)
+
+        logging.debug('setting up SSL connection')
+
+        start_time = time.time()
+        try:
+            self.sock = context.wrap_socket(
+                self.sock, server_hostname=self.server, session=session)
+        except ssl.SSLError:
+            if session is None: raise
+            # A stale session can be rejected outright by some servers.
+            # Forget it and retry with a full handshake.
+            logging.debug('TLS session resumption failed; retrying')
+            TlsTransport.ssl_sessions.pop(session_key, None)
+            self.sock.close()
+            self.connect()
+            return
+
+        self.handshake = (time.time() - start_time, self.sock.session_reused)
+
+        self.save_session()
+
+    def save_session(self):
+        ''' Stores the current TLS session for resumption on reconnect.
+
+        With TLS 1.3 the session ticket arrives after the handshake, so
+        this is called again at close time.
+        '''
+        if not self.session_reuse or self.sock is None:
+            return
+
+        session = self.sock.session
+        if session is not None and session.has_ticket:
+            TlsTransport.ssl_sessions[
+                (self.server, self.port, self.sock.context)] = session
+
+    def send(self, bufs):
+        # SSL sockets do not support sendmsg()
+        if len(bufs) > 0:
+            self.sendall(bufs)
+
+    def close(self):
+        self.save_session()
+        super(TlsTransport, self).close()
+
+
+class UnixTransport(SocketTransport):
+    ''' Unix domain socket transport, for a SIP server on the same host '''
+
+    def __init__(self, path, timeout=None):
+        super(UnixTransport, self).__init__()
+        self.path = path
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.path)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+
+class SocketPairTransport(SocketTransport):
+    ''' Connected in-process socket pair.
+
+    The server side of the pair is available as 'peer' once connected,
+    for use by an in-process (e.g. threaded) test server.
+    '''
+
+    def __init__(self):
+        super(SocketPairTransport, self).__init__()
+        self.peer = None
+
+    def connect(self):
+        self.sock, self.peer = socket.socketpair()
+
+    def close(self):
+        super(SocketPairTransport, self).close()
+        if self.peer is not None:
+            self.peer.close()
+            self.peer = None
+
+
+class LoopbackTransport(Transport):
+    ''' Purely in-memory transport, no kernel involvement.
+
+    handler is called with each complete request frame (bytes) and
+    returns the response frame (bytes) or None for no response.
+    Useful for measuring client-side CPU cost in isolation.
+    '''
+
+    def __init__(self, handler, terminator=b'\r'):
+        super(LoopbackTransport, self).__init__()
+        self.handler = handler
+        self.terminator = terminator
+        self.request = bytearray()
+        self.response = bytearray()
+        self.connected = False
+
+    def connect(self):
+        self.connected = True
+        del self.request[:]
+        del self.response[:]
+
+    def send(self, bufs):
+        if not self.connected:
+            raise IOError('Loopback transport is not connected')
+
+        for buf in bufs:
+            self.request += buf
+
+        while True:
+            idx = self.request.find(self.terminator)
+            if idx < 0: break
+            end = idx + len(self.terminator)
+            resp = self.handler(bytes(self.request[:end]))
+            del self.request[:end]
+            if resp is not None:
+                self.response += resp
+
+    def recv_into(self, buf):
+        if not self.connected:
+            return 0
+        nbytes = min(len(buf), len(self.response))
+        if nbytes == 0:
+            # nothing queued means the handler will never answer;
+            # report it the same way a closed socket would.
+            return 0
+        buf[:nbytes] = self.response[:nbytes]
+        del self.response[:nbytes]
+        return nbytes
+
+    def close(self):
+        self.connected = False
@@ -0,0 +1,194 @@
+# -----------------------------------------------------------------------
+# Copyright (C) 2015 King County Library System
+# Bill Erickson <berickxx@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# -----------------------------------------------------------------------
+'''
+Typed, read-only views over raw SIP2 message text.
+
+One view class is generated per MessageSpec, e.g. CheckoutResponse or
+PatronInfoResponse.  Each fixed field is exposed as an attribute that
+reads directly from the message text at an offset computed once from
+the spec's fixed field lengths:
+
+    view = views.view_for(msg_txt)
+    if view.ok: ...
+    view.charged_items_count    # int
+    view.patron_status.card_reported_lost
+'''
+from pysip2.spec import MessageSpec as mspec
+from pysip2.spec import FixedFieldSpec as ffspec
+from pysip2.dates import parse_sipdate
+
+class PatronStatusFlags(int):
+    ''' Patron status fixed field as a bit mask.  A 'Y' in position N
+    of the 14-character field sets bit N.  Each flag is also available
+    as a boolean attribute, e.g. status.card_reported_lost
+    '''
+
+    FLAGS = (
+        'charge_privileges_denied',
+        'renewal_privileges_denied',
+        'recall_privileges_denied',
+        'hold_privileges_denied',
+        'card_reported_lost',
+        'too_many_items_charged',
+        'too_many_items_overdue',
+        'too_many_renewals',
+        'too_many_claims_of_items_returned',
+        'too_many_items_lost',
+        'excessive_outstanding_fines',
+        'excessive_outstanding_fees',
+        'recall_overdue',
+        'too_many_items_billed'
+    )
+
+    @staticmethod
+    def parse(value):
+        bits = 0
+        for pos in range(min(len(value), len(PatronStatusFlags.FLAGS))):
+            if value[pos] == 'Y':
+                bits = bits | (1 << pos)
+        return PatronStatusFlags(bits)
+
+    def __repr__(self):
+        return 'PatronStatusFlags(%s)' % '|'.join([f for pos, f in
+            enumerate(PatronStatusFlags.FLAGS) if self & (1 << pos)])
+
+def flag_property(bit):
+    return property(lambda self: bool(self & bit))
+
+for pos, name in enumerate(PatronStatusFlags.FLAGS):
+    setattr(PatronStatusFlags, name, flag_property(1 << pos))
+
+
+# Fixed fields with non-string types
+FLAG_FIELDS = set([
+    'ok', 'renewal_ok', 'magnetic_media', 'desensitize', 'resensitize',
+    'alert', 'online_status', 'checkin_ok', 'checkout_ok',
+    'acs_renewal_policy', 'status_update_ok', 'offline_ok',
+    'payment_accepted', 'no_block', 'sc_renewal_policy',
+    'third_party_allowed', 'card_retained', 'available',
+    'item_properties_ok', 'end_session'
+])
+
+NUMBER_FIELDS = set([
+    'hold_items_count', 'overdue_items_count', 'charged_items_count',
+    'fine_items_count', 'recall_items_count', 'unavail_holds_count',
+    'timeout_period', 'retries_allowed', 'max_print_width',
+    'renewed_count', 'unrenewed_count'
+])
+
+class FixedFieldAccessor(object):
+    ''' Descriptor reading one fixed field string from a view's raw text '''
+
+    def __init__(self, spec, offset):
+        self.spec = spec
+        self.offset = offset
+        self.end = offset + spec.length
+
+    def __get__(self, view, owner):
+        if view is None: return self
+        return view.msg_txt[self.offset:self.end]
+
+class FlagAccessor(FixedFieldAccessor):
+    ''' Y/1 => True, N/0 => False, anything else (e.g. U) => None '''
+
+    def __get__(self, view, owner):
+        if view is None: return self
+        # single character indexing does not allocate
+        c = view.msg_txt[self.offset]
+        if c == 'Y' or c == '1': return True
+        if c == 'N' or c == '0': return False
+        return None
+
+class NumberAccessor(FixedFieldAccessor):
+    ''' Numeric fixed field => int, or None if blank / non-numeric '''
+
+    def __get__(self, view, owner):
+        if view is None: return self
+        value = view.msg_txt[self.offset:self.end].strip()
+        if value.isdigit(): return int(value)
+        return None
+
+class PatronStatusAccessor(FixedFieldAccessor):
+
+    def __get__(self, view, owner):
+        if view is None: return self
+        return PatronStatusFlags.parse(view.msg_txt[self.offset:self.end])
+
+def accessor_for(spec, offset):
+    if spec.name in FLAG_FIELDS:
+        return FlagAccessor(spec, offset)
+    if spec.name in NUMBER_FIELDS:
+        return NumberAccessor(spec, offset)
+    if spec.name == 'patron_status':
+        return PatronStatusAccessor(spec, offset)
+    return FixedFieldAccessor(spec, offset)
+
+
+class MessageView(object):
+    ''' Base class for generated view classes '''
+
+    __slots__ = ('msg_txt',)
+
+    spec = None
+
+    def __init__(self, msg_txt):
+        self.msg_txt = msg_txt
+
+    def raw(self, name):
+        ''' Returns the untyped string value of the named fixed field '''
+        accessor = getattr(type(self), name)
+        return self.msg_txt[accessor.offset:accessor.end]
+
+    def datetime(self, name):
+        ''' Returns the named date fixed field as a datetime, or None '''
+        return parse_sipdate(self.raw(name))
+
+    def __str__(self):
+        return self.msg_txt
+
+
+# code => generated view class
+registry = {}
+
+def class_name(spec):
+    ''' checkout_resp => CheckoutResponse '''
+    name = ''.join([p.capitalize() for p in spec.name.split('_')])
+    if name.endswith('Resp'):
+        name = name + 'onse'
+    return name
+
+def build_view(spec):
+    ''' Creates and registers the view class for a MessageSpec '''
+
+    attrs = {'__slots__': (), 'spec': spec}
+    for ff, offset in spec.fixed_field_offsets():
+        attrs[ff.name] = accessor_for(ff, offset)
+
+    cls = type(class_name(spec), (MessageView,), attrs)
+    registry[spec.code] = cls
+    globals()[cls.__name__] = cls
+    return cls
+
+def view_for(msg_txt):
+    ''' Returns a typed view for the raw message text, or None if the
+    message code has no known spec.
+    '''
+    cls = registry.get(msg_txt[:2])
+    if cls is None:
+        return None
+    return cls(msg_txt)
+
+for spec in list(mspec.registry.values()):
+    build_view(spec)